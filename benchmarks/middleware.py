@@ -0,0 +1,230 @@
+"""
+In-process benchmarks of foxglove middleware using the demo app from tests/demo, run with:
+
+    python benchmarks/middleware.py
+
+Requests are made directly against the ASGI app without a server so the numbers reflect only the cost
+of routing, middleware and the endpoint.
+"""
+import asyncio
+import json
+import logging
+import sys
+from base64 import b64encode
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+import itsdangerous
+from fastapi import FastAPI
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.middleware.sessions import SessionMiddleware as StarletteSessionMiddleware
+
+sys.path[:0] = [str(Path(__file__).parent.parent / 'tests'), str(Path(__file__).parent.parent)]
+
+from demo.settings import Settings  # noqa: E402
+from foxglove import glove  # noqa: E402
+
+glove._settings = Settings(test_mode=True)
+
+from demo.main import app as demo_app, should_check_csrf  # noqa: E402
+from foxglove.context import RequestContextMiddleware  # noqa: E402
+from foxglove.db import AsgiPgMiddleware, PgMiddleware  # noqa: E402
+from foxglove.middleware import (  # noqa: E402
+    AsgiCsrfMiddleware,
+    AsgiErrorMiddleware,
+    AsgiHostRedirectMiddleware,
+    CloudflareCheckMiddleware,
+    CsrfMiddleware,
+    ErrorMiddleware,
+    FoxgloveStack,
+    HostRedirectMiddleware,
+)
+from foxglove.sessions import SessionMiddleware as FoxgloveSessionMiddleware  # noqa: E402
+
+Headers = Sequence[Tuple[str, str]]
+
+
+def session_cookie(session: Dict[str, Any]) -> str:
+    signer = itsdangerous.TimestampSigner(glove.settings.secret_key)
+    return signer.sign(b64encode(json.dumps(session).encode())).decode()
+
+
+request_headers: Headers = [
+    # as if the request came via CloudFlare, other middleware ignore this
+    ('x-forwarded-for', '1.1.1.1, 162.158.90.14'),
+    # as if the user has already visited the site
+    ('cookie', f'{glove.settings.cookie_name}={session_cookie({"session_id": "0" * 43})}'),
+]
+benchmarks: Dict[str, Callable[[], List[Tuple[str, FastAPI]]]] = {}
+
+
+def benchmark(f):
+    benchmarks[f.__name__] = f
+    return f
+
+
+def build_app(*middleware: Middleware) -> FastAPI:
+    return FastAPI(routes=demo_app.routes, middleware=middleware, exception_handlers=demo_app.exception_handlers)
+
+
+session_middleware = Middleware(FoxgloveSessionMiddleware, same_site='strict')
+starlette_session_middleware = Middleware(
+    StarletteSessionMiddleware,
+    secret_key=glove.settings.secret_key,
+    session_cookie=glove.settings.cookie_name,
+    same_site='strict',
+)
+
+
+def demo_stack(error_middleware: type) -> List[Middleware]:
+    return [
+        Middleware(error_middleware),
+        session_middleware,
+        Middleware(CsrfMiddleware, should_check=should_check_csrf),
+        Middleware(PgMiddleware),
+    ]
+
+
+@benchmark
+def error_middleware():
+    return [
+        ('ErrorMiddleware', build_app(*demo_stack(ErrorMiddleware))),
+        ('AsgiErrorMiddleware', build_app(*demo_stack(AsgiErrorMiddleware))),
+    ]
+
+
+@benchmark
+def foxglove_stack():
+    return [
+        ('separate middleware', build_app(*demo_stack(ErrorMiddleware))),
+        (
+            'FoxgloveStack',
+            build_app(session_middleware, Middleware(FoxgloveStack, should_check_csrf=should_check_csrf)),
+        ),
+    ]
+
+
+@benchmark
+def csrf_middleware():
+    return [
+        ('CsrfMiddleware', build_app(session_middleware, Middleware(CsrfMiddleware, should_check=should_check_csrf))),
+        (
+            'AsgiCsrfMiddleware',
+            build_app(session_middleware, Middleware(AsgiCsrfMiddleware, should_check=should_check_csrf)),
+        ),
+    ]
+
+
+@benchmark
+def sessions():
+    csrf = Middleware(AsgiCsrfMiddleware, should_check=should_check_csrf)
+    return [
+        ('starlette SessionMiddleware', build_app(starlette_session_middleware, csrf)),
+        ('foxglove SessionMiddleware', build_app(session_middleware, csrf)),
+    ]
+
+
+@benchmark
+def pg_middleware():
+    return [
+        ('PgMiddleware', build_app(Middleware(PgMiddleware))),
+        ('AsgiPgMiddleware', build_app(Middleware(AsgiPgMiddleware))),
+    ]
+
+
+@benchmark
+def host_redirect():
+    return [
+        ('no middleware', build_app()),
+        ('HostRedirectMiddleware', build_app(Middleware(HostRedirectMiddleware, host='testserver'))),
+        ('AsgiHostRedirectMiddleware', build_app(Middleware(AsgiHostRedirectMiddleware, host='testserver'))),
+    ]
+
+
+@benchmark
+def cloudflare_check():
+    class DispatchCloudflareCheck(BaseHTTPMiddleware):
+        dispatch = CloudflareCheckMiddleware(None).dispatch
+
+    return [
+        ('no middleware', build_app()),
+        ('BaseHTTPMiddleware dispatch', build_app(Middleware(DispatchCloudflareCheck))),
+        ('CloudflareCheckMiddleware', build_app(Middleware(CloudflareCheckMiddleware))),
+    ]
+
+
+@benchmark
+def request_context():
+    return [
+        ('no middleware', build_app()),
+        ('RequestContextMiddleware', build_app(Middleware(RequestContextMiddleware))),
+        ('no response header', build_app(Middleware(RequestContextMiddleware, response_header=False))),
+    ]
+
+
+async def make_request(app: FastAPI, path: str, headers: Headers = request_headers) -> int:
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'root_path': '',
+        'query_string': query.encode(),
+        'headers': [(b'host', b'testserver')] + [(k.encode(), v.encode()) for k, v in headers],
+        'client': ('127.0.0.1', 50000),
+        'server': ('testserver', 80),
+    }
+    status = 0
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if request_sent:
+            # like a real server, block until the client disconnects, which in this case is never
+            await asyncio.Event().wait()
+        request_sent = True
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+
+    await app(scope, receive, send)
+    return status
+
+
+async def time_app(app: FastAPI, path: str, iterations: int) -> float:
+    # warm up, this also builds the middleware stack
+    for _ in range(100):
+        await make_request(app, path)
+
+    start = perf_counter()
+    for _ in range(iterations):
+        await make_request(app, path)
+    return (perf_counter() - start) / iterations
+
+
+async def run(names: List[str], iterations: int) -> None:
+    # error responses are logged, that's not what we're measuring here
+    logging.disable(logging.CRITICAL)
+    for name in names:
+        print(f'{name}:')
+        for path in '/', '/error/?error=return':
+            results = []
+            for label, app in benchmarks[name]():
+                results.append((label, await time_app(app, path, iterations)))
+
+            baseline = results[0][1]
+            for label, t in results:
+                print(f'  GET {path:<22} {label:<28} {t * 1e6:8.1f}µs/request {baseline / t:5.2f}x')
+
+
+if __name__ == '__main__':
+    asyncio.run(run(sys.argv[1:] or list(benchmarks), iterations=5_000))
@@ -0,0 +1,291 @@
+import asyncio
+import hashlib
+import json
+import logging
+from functools import wraps
+from time import time
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple, Union
+
+from fastapi.encoders import jsonable_encoder
+from redis.exceptions import RedisError
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+from . import glove
+
+logger = logging.getLogger('foxglove.cache')
+
+__all__ = 'cached_response', 'coalesce_requests', 'default_coalesce_key'
+
+# headers which are never stored with cached responses
+excluded_headers = {b'set-cookie', b'content-length', b'x-cache'}
+# how often requests waiting for another request to compute a response check if it's available
+wait_poll_interval = 0.05
+
+
+class CachedResponse:
+    """
+    Response stored in redis as a JSON line with the status, headers and time until which it's fresh, then the body.
+    """
+
+    __slots__ = 'status_code', 'headers', 'fresh_until', 'body'
+
+    def __init__(self, status_code: int, headers: List[Tuple[str, str]], fresh_until: float, body: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.fresh_until = fresh_until
+        self.body = body
+
+    @classmethod
+    def from_response(cls, response: Response, fresh_until: float) -> 'CachedResponse':
+        headers = [
+            (k.decode('latin-1'), v.decode('latin-1')) for k, v in response.raw_headers if k not in excluded_headers
+        ]
+        return cls(response.status_code, headers, fresh_until, response.body)
+
+    @classmethod
+    def loads(cls, data: bytes) -> 'CachedResponse':
+        meta, _, body = data.partition(b'\n')
+        status_code, headers, fresh_until = json.loads(meta)
+        return cls(status_code, headers, fresh_until, body)
+
+    def dumps(self) -> bytes:
+        return json.dumps([self.status_code, self.headers, self.fresh_until]).encode() + b'\n' + self.body
+
+    def response(self, cache_status: Optional[str] = None) -> Response:
+        response = Response(self.body, status_code=self.status_code)
+        response.raw_headers += [(k.encode('latin-1'), v.encode('latin-1')) for k, v in self.headers]
+        if cache_status:
+            response.headers['X-Cache'] = cache_status
+        return response
+
+
+def cached_response(
+    ttl: int,
+    *,
+    stale_ttl: int = 0,
+    vary_query: Union[bool, Iterable[str]] = True,
+    vary_headers: Iterable[str] = (),
+    vary_session: bool = False,
+    key_prefix: Optional[str] = None,
+    lock_timeout: int = 30,
+) -> Callable[[Callable], Callable]:
+    """
+    Cache successful responses of a GET view in redis for ttl seconds. Like FoxgloveTemplates.render, views must
+    take "request" as their first argument, they may return a Response or data which is returned as JSON.
+
+    Cache keys vary on the query string (or just the parameters listed in vary_query), the headers listed in
+    vary_headers and, if vary_session is True, the session.
+
+    For stale_ttl seconds after a response expires, one request (in any worker) recomputes the response while
+    holding a lock and other requests get the stale response, so expensive views aren't run concurrently
+    when an entry expires. Responses include an "X-Cache" header of "hit", "stale" or "miss".
+    """
+
+    def view_decorator(view: Callable) -> Callable:
+        cache = ResponseCache(
+            view,
+            ttl=ttl,
+            stale_ttl=stale_ttl,
+            vary_query=vary_query,
+            vary_headers=vary_headers,
+            vary_session=vary_session,
+            key_prefix=key_prefix,
+            lock_timeout=lock_timeout,
+        )
+
+        @wraps(view)
+        async def view_wrapper(request: Request, *args, **kwargs):
+            return await cache.get_response(request, args, kwargs)
+
+        return view_wrapper
+
+    return view_decorator
+
+
+class ResponseCache:
+    """
+    Used by cached_response, the state and logic for one view.
+    """
+
+    def __init__(
+        self,
+        view: Callable,
+        *,
+        ttl: int,
+        stale_ttl: int,
+        vary_query: Union[bool, Iterable[str]],
+        vary_headers: Iterable[str],
+        vary_session: bool,
+        key_prefix: Optional[str],
+        lock_timeout: int,
+    ):
+        self.view = view
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.vary_query = vary_query
+        self.query_params = None if isinstance(vary_query, bool) else tuple(vary_query)
+        self.vary_headers = tuple(h.lower() for h in vary_headers)
+        self.vary_session = vary_session
+        self.key_prefix = key_prefix or f'{view.__module__}.{view.__qualname__}'
+        self.lock_timeout = lock_timeout
+
+    async def get_response(self, request: Request, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> Response:
+        if request.method not in ('GET', 'HEAD'):
+            return await run_view(self.view, request, args, kwargs)
+
+        key = self.key(request)
+        lock_key = f'{key}:lock'
+        try:
+            data = await glove.redis.get(key)
+            cached = data and CachedResponse.loads(data)
+            if cached and cached.fresh_until > time():
+                return cached.response('hit')
+
+            # the response is missing or stale, only one request should update it
+            locked = await glove.redis.set(lock_key, b'1', nx=True, ex=self.lock_timeout)
+            if not locked:
+                if cached:
+                    return cached.response('stale')
+                elif cached := await self.wait_for_response(key, lock_key):
+                    return cached.response('hit')
+        except RedisError as e:
+            # if redis is unavailable, responses are generated as if they weren't cached
+            log_redis_error('getting cached response', e)
+            return await run_view(self.view, request, args, kwargs)
+
+        try:
+            response = await run_view(self.view, request, args, kwargs)
+            if response.status_code == 200 and cacheable(response):
+                cached = CachedResponse.from_response(response, time() + self.ttl)
+                try:
+                    await glove.redis.set(key, cached.dumps(), ex=self.ttl + self.stale_ttl)
+                except RedisError as e:
+                    log_redis_error('caching response', e)
+        finally:
+            if locked:
+                try:
+                    await glove.redis.delete(lock_key)
+                except RedisError as e:
+                    # the lock expires after lock_timeout
+                    log_redis_error('releasing cache lock', e)
+
+        response.headers['X-Cache'] = 'miss'
+        return response
+
+    async def wait_for_response(self, key: str, lock_key: str) -> Optional[CachedResponse]:
+        """
+        Wait for the request holding the lock to store a response, returns None if the lock is released
+        without a response being stored or it times out.
+        """
+        deadline = time() + self.lock_timeout
+        while time() < deadline:
+            await asyncio.sleep(wait_poll_interval)
+            data, lock = await glove.redis.mget(key, lock_key)
+            if data is not None:
+                return CachedResponse.loads(data)
+            elif lock is None:
+                return None
+        return None
+
+    def key(self, request: Request) -> str:
+        parts: List[Any] = [request.url.path]
+        if self.query_params is not None:
+            parts.append([request.query_params.getlist(p) for p in self.query_params])
+        elif self.vary_query:
+            parts.append(sorted(request.query_params.multi_items()))
+        if self.vary_headers:
+            parts.append([request.headers.get(h) for h in self.vary_headers])
+        if self.vary_session:
+            parts.append(dict(request.session))
+        digest = hashlib.blake2b(json.dumps(parts, sort_keys=True).encode(), digest_size=16).hexdigest()
+        return f'cache:{self.key_prefix}:{digest}'
+
+
+async def run_view(view: Callable, request: Request, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> Response:
+    if asyncio.iscoroutinefunction(view):
+        r = await view(request, *args, **kwargs)
+    else:
+        r = await run_in_threadpool(view, request, *args, **kwargs)
+    if isinstance(r, Response):
+        return r
+    else:
+        return JSONResponse(jsonable_encoder(r))
+
+
+def log_redis_error(action: str, exc: RedisError) -> None:
+    logger.warning('error %s, %s: %s', action, exc.__class__.__name__, exc)
+
+
+def cacheable(response: Response) -> bool:
+    return copyable(response) and 'set-cookie' not in response.headers
+
+
+def copyable(response: Response) -> bool:
+    # streaming responses have no body
+    return hasattr(response, 'body')
+
+
+def default_coalesce_key(request: Request) -> Hashable:
+    """
+    Requests are only coalesced if they have the same method, path and query string, and the same cookies
+    and Authorization header so responses are never shared between users.
+    """
+    headers = request.headers
+    return request.method, request.url.path, request.url.query, headers.get('cookie'), headers.get('authorization')
+
+
+def coalesce_requests(key: Callable[[Request], Hashable] = default_coalesce_key) -> Callable[[Callable], Callable]:
+    """
+    Coalesce identical concurrent GET and HEAD requests to a view within this process: while a response is being
+    generated, other requests with the same key wait for it and get a copy instead of running the view again.
+
+    Like cached_response, views must take "request" as their first argument and may return a Response or data
+    which is returned as JSON. Set-Cookie headers are not copied to other requests, streaming responses can't
+    be copied so waiting requests run the view themselves.
+    """
+
+    def view_decorator(view: Callable) -> Callable:
+        in_flight: Dict[Hashable, 'asyncio.Future[Optional[CachedResponse]]'] = {}
+
+        @wraps(view)
+        async def view_wrapper(request: Request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return await run_view(view, request, args, kwargs)
+
+            request_key = key(request)
+            future = in_flight.get(request_key)
+            if future is not None:
+                try:
+                    copy = await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    # if the request generating the response was cancelled, run the view, otherwise this request
+                    # was cancelled
+                    if not future.cancelled():
+                        raise
+                else:
+                    if copy is not None:
+                        return copy.response()
+                return await run_view(view, request, args, kwargs)
+
+            in_flight[request_key] = future = asyncio.get_running_loop().create_future()
+            try:
+                response = await run_view(view, request, args, kwargs)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as exc:
+                future.set_exception(exc)
+                # mark the exception as retrieved in case no requests were waiting
+                future.exception()
+                raise
+            else:
+                future.set_result(CachedResponse.from_response(response, 0) if copyable(response) else None)
+                return response
+            finally:
+                in_flight.pop(request_key, None)
+
+        return view_wrapper
+
+    return view_decorator
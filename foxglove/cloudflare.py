@@ -0,0 +1,324 @@
+import asyncio
+import logging
+import os
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network, ip_address, ip_network
+from pathlib import Path
+from time import time
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Literal, Optional, Tuple, Union
+
+from . import glove
+from .context import request_context
+from .exceptions import UnexpectedResponse
+
+if TYPE_CHECKING:
+    from .settings import BaseSettings
+
+logger = logging.getLogger('foxglove.cloudflare')
+
+__all__ = 'CloudflareIPs', 'IPRangeTable', 'IPRangeCounter', 'VerdictCache', 'get_cloudflare_ips'
+
+IPAddress = Union[IPv4Address, IPv6Address]
+IPNetwork = Union[IPv4Network, IPv6Network]
+
+
+class IPRangeCounter:
+    __slots__ = 'range', 'counter'
+
+    def __init__(self, network_range: Union[str, IPNetwork], counter: int = 0):
+        self.range = ip_network(network_range)
+        self.counter = counter
+
+    def __repr__(self):
+        return f'IPRangeCounter({self.range}, {self.counter})'
+
+
+class _FamilyTable:
+    """
+    Networks of one address family as integer intervals sorted by start address.
+
+    max_ends[i] is the largest end of intervals 0..i, so a lookup can stop as soon as no earlier interval
+    could contain the address, with non-overlapping networks (the normal case) a lookup is a single bisect.
+    """
+
+    __slots__ = 'starts', 'ends', 'max_ends', 'indexes'
+
+    def __init__(self, networks: List[Tuple[int, IPNetwork]]):
+        networks.sort(key=lambda n: int(n[1].network_address))
+        self.starts = [int(n.network_address) for _, n in networks]
+        self.ends = [int(n.broadcast_address) for _, n in networks]
+        self.indexes = [index for index, _ in networks]
+        self.max_ends = []
+        max_end = -1
+        for end in self.ends:
+            max_end = max(max_end, end)
+            self.max_ends.append(max_end)
+
+    def find(self, ip: int) -> Optional[int]:
+        i = bisect_right(self.starts, ip) - 1
+        while i >= 0 and self.max_ends[i] >= ip:
+            if self.ends[i] >= ip:
+                return self.indexes[i]
+            i -= 1
+
+
+class IPRangeTable:
+    """
+    Table of IP networks for O(log n) lookups of addresses.
+
+    Hits are counted per network in an array indexed by the network's position in the original list,
+    so counting never requires the table to be reordered.
+    """
+
+    __slots__ = 'networks', 'counters', '_tables'
+
+    def __init__(self, networks: Iterable[Union[str, IPNetwork]]):
+        self.networks: List[IPNetwork] = [ip_network(n) for n in networks]
+        self.counters = array('Q', [0]) * len(self.networks)
+        by_version: Dict[int, List[Tuple[int, IPNetwork]]] = {4: [], 6: []}
+        for index, network in enumerate(self.networks):
+            by_version[network.version].append((index, network))
+        self._tables = {version: _FamilyTable(networks) for version, networks in by_version.items()}
+
+    def find(self, ip: IPAddress) -> Optional[int]:
+        """
+        Find the index of the network containing an address, without counting the hit.
+        """
+        return self._tables[ip.version].find(int(ip))
+
+    def match(self, ip: IPAddress) -> bool:
+        """
+        Check if an address is in one of the networks, if it is, count the hit.
+        """
+        index = self.find(ip)
+        if index is None:
+            return False
+        else:
+            self.counters[index] += 1
+            return True
+
+    def hit_counts(self) -> List[IPRangeCounter]:
+        """
+        Networks with their hit counts, most hit first.
+        """
+        counters = [IPRangeCounter(n, c) for n, c in zip(self.networks, self.counters)]
+        counters.sort(key=lambda c: c.counter, reverse=True)
+        return counters
+
+    def __iter__(self) -> Iterator[IPRangeCounter]:
+        # iterating gives the same IPRangeCounter items as the list get_cloudflare_ips used to return
+        return iter(self.hit_counts())
+
+    def __len__(self) -> int:
+        return len(self.networks)
+
+    def __repr__(self):
+        return f'IPRangeTable({self.hit_counts()})'
+
+
+class VerdictCache:
+    """
+    Bounded LRU cache of raw IP strings to the index of the network containing them, or -1 if the IP
+    is invalid or not in any network.
+    """
+
+    __slots__ = 'max_size', 'hits', 'misses', '_verdicts'
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._verdicts: 'OrderedDict[Union[str, bytes], int]' = OrderedDict()
+
+    def get(self, ip: Union[str, bytes]) -> Optional[int]:
+        index = self._verdicts.get(ip)
+        if index is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._verdicts.move_to_end(ip)
+        return index
+
+    def set(self, ip: Union[str, bytes], index: int) -> None:
+        self._verdicts[ip] = index
+        if len(self._verdicts) > self.max_size:
+            self._verdicts.popitem(last=False)
+
+    def clear(self) -> None:
+        self._verdicts.clear()
+
+    def __len__(self) -> int:
+        return len(self._verdicts)
+
+    def __repr__(self):
+        return f'VerdictCache(size={len(self)}, hits={self.hits}, misses={self.misses})'
+
+
+class CloudflareIPs:
+    """
+    Current CloudFlare IP ranges, used by CloudflareCheckMiddleware via glove.cloudflare_ips.
+
+    Ranges are loaded from settings.cloudflare_ips_cache_path if it exists, otherwise from the snapshot bundled
+    with foxglove, so they're available immediately without blocking on a download. They're then refreshed
+    from CloudFlare every settings.cloudflare_ips_refresh_interval seconds in a background task.
+
+    Since the same edge IPs are seen repeatedly, results of checks are cached by raw IP string in "verdicts",
+    the cache is cleared whenever the table is replaced.
+    """
+
+    def __init__(self, settings: 'BaseSettings'):
+        self.settings = settings
+        self.table, self.age = load_cloudflare_ips(
+            settings.cloudflare_ips_cache_path, settings.cloudflare_ips_min_ranges
+        )
+        self.verdicts = VerdictCache(settings.cloudflare_verdict_cache_size)
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._loop_task: Optional[asyncio.Task] = None
+
+    def check(self, ip: Union[str, bytes]) -> bool:
+        """
+        Check if a raw IP string, e.g. from the X-Forwarded-For header, is a CloudFlare IP.
+        """
+        table = self.table
+        index = self.verdicts.get(ip)
+        if index is None:
+            try:
+                address = ip_address(ip.decode() if isinstance(ip, bytes) else ip)
+            except ValueError:
+                index = -1
+            else:
+                found = table.find(address)
+                index = -1 if found is None else found
+            self.verdicts.set(ip, index)
+
+        if index < 0:
+            return False
+        else:
+            table.counters[index] += 1
+            return True
+
+    def start(self) -> None:
+        """
+        Start the background refresh task, this requires a running event loop.
+        """
+        if self.settings.cloudflare_ips_refresh_interval is not None and self._loop_task is None:
+            self._loop_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self) -> None:
+        for task in self._loop_task, self._refresh_task:
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+        self._loop_task = self._refresh_task = None
+
+    async def refresh(self) -> IPRangeTable:
+        """
+        Download the ranges from CloudFlare, save them to the cache file and swap them in, implausibly small
+        downloads raise ValueError and are neither saved nor used.
+
+        Concurrent calls share one download.
+        """
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh())
+            self._refresh_task.add_done_callback(self._refresh_done)
+        return await asyncio.shield(self._refresh_task)
+
+    async def _refresh(self) -> IPRangeTable:
+        table = await get_cloudflare_ips(self.settings.cloudflare_url)
+        # an empty or truncated download would reject most or all legitimate requests, keep the current ranges
+        if error := implausible_error(table, self.settings.cloudflare_ips_min_ranges):
+            raise ValueError(f'implausible CloudFlare IPs, {error}, keeping the current {len(self.table)} ranges')
+        if cache_path := self.settings.cloudflare_ips_cache_path:
+            save_cloudflare_ips(cache_path, table)
+        # a single assignment, so requests see either the old table or the new one, there's no await between
+        # the swap and clearing verdicts so no request can see cached verdicts from the old table
+        self.table, self.age = table, 0
+        self.verdicts.clear()
+        return table
+
+    def _refresh_done(self, task: asyncio.Task) -> None:
+        self._refresh_task = None
+        if not task.cancelled():
+            # mark the exception as retrieved, callers of refresh() get it from the shielded task
+            task.exception()
+
+    async def _refresh_loop(self) -> None:
+        # this task may have been started during a request, its logs shouldn't be attributed to that request
+        request_context.set(None)
+        interval = self.settings.cloudflare_ips_refresh_interval
+        # if the ranges were loaded from a recent cache file, we don't need to refresh them immediately
+        delay = max(interval - self.age, 0)
+        while True:
+            await asyncio.sleep(delay)
+            delay = interval
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning('error refreshing CloudFlare IPs, %s: %s', e.__class__.__name__, e)
+
+
+snapshot_path = Path(__file__).parent / 'cloudflare_ips.txt'
+
+
+def implausible_error(table: IPRangeTable, min_ranges: int) -> Optional[str]:
+    """
+    Reason ranges don't look like a complete set of CloudFlare's ranges, or None if they do.
+    """
+    if len(table) < min_ranges or {n.version for n in table.networks} != {4, 6}:
+        return f'got {len(table)} ranges, expected at least {min_ranges} including IPv4 and IPv6 ranges'
+
+
+def load_cloudflare_ips(cache_path: Optional[Path], min_ranges: int = 0) -> Tuple[IPRangeTable, float]:
+    """
+    Load IP ranges from the cache file if it exists or the bundled snapshot, returns the table and its age
+    in seconds, the snapshot is treated as infinitely old so ranges are refreshed immediately. Cache files which
+    can't be read or have implausible ranges (see implausible_error) are ignored.
+    """
+    if cache_path and cache_path.exists():
+        try:
+            table = IPRangeTable(cache_path.read_text().split())
+            age = time() - cache_path.stat().st_mtime
+        except (OSError, ValueError) as e:
+            logger.warning('invalid CloudFlare IPs cache file "%s", %s', cache_path, e)
+        else:
+            if error := implausible_error(table, min_ranges):
+                logger.warning('invalid CloudFlare IPs cache file "%s", %s', cache_path, error)
+            else:
+                logger.debug('loaded %d CloudFlare IPs from "%s"', len(table), cache_path)
+                return table, age
+
+    return IPRangeTable(snapshot_path.read_text().split()), float('inf')
+
+
+def save_cloudflare_ips(cache_path: Path, table: IPRangeTable) -> None:
+    """
+    Write the ranges to a temporary file, then move it into place so readers never see a partial file.
+    """
+    tmp_path = cache_path.with_name(f'.{cache_path.name}.{os.getpid()}.tmp')
+    tmp_path.write_text(''.join(f'{n}\n' for n in table.networks))
+    os.replace(tmp_path, cache_path)
+
+
+async def get_cloudflare_ips(cloudflare_url: str = 'https://www.cloudflare.com') -> IPRangeTable:
+    """
+    Get a list of cloudflare IPs from https://www.cloudflare.com/ips-v4 and https://www.cloudflare.com/ips-v6,
+    see https://www.cloudflare.com/en-gb/ips/ for details.
+
+    The IPRangeTable returned can be iterated over and has a length like the list of IPRangeCounter returned
+    by earlier versions.
+    """
+
+    async def get_ips(v: Literal[4, 6]) -> List[str]:
+        r = await glove.http.get(f'{cloudflare_url}/ips-v{v}', follow_redirects=True)
+        UnexpectedResponse.check(r)
+        return r.text.split()
+
+    v4_ips, v6_ips = await asyncio.gather(get_ips(4), get_ips(6))
+    table = IPRangeTable(v4_ips + v6_ips)
+    logger.info('downloaded %d IPs from CloudFlare to check requests against', len(table))
+    return table
@@ -0,0 +1,241 @@
+import os
+import re
+import stat
+import zlib
+from mimetypes import guess_type
+from typing import Optional, Sequence, Tuple, Union
+
+import anyio
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .utils import get_header
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+__all__ = 'CompressionMiddleware', 'PrecompressedStaticFiles', 'choose_encoding'
+
+# content types worth compressing, event streams are excluded since compression would buffer events
+compressible_content_type = re.compile(
+    rb'text/(?!event-stream)|application/(json|javascript|xml|[\w.-]+\+(json|xml))|image/svg\+xml', re.I
+)
+# statuses which have no body or where the body must not be changed
+skip_statuses = {204, 206, 304}
+
+
+def choose_encoding(accept_encoding: bytes, encodings: Sequence[str]) -> Optional[str]:
+    """
+    First of encodings accepted by the client according to an Accept-Encoding header, encodings are in order of
+    the server's preference. "*" matches any encoding the client hasn't explicitly refused with "q=0".
+    """
+    accepted = set()
+    refused = set()
+    for part in accept_encoding.lower().split(b','):
+        coding, _, params = part.partition(b';')
+        coding = coding.strip()
+        params = params.strip()
+        if params.startswith(b'q='):
+            try:
+                if float(params[2:]) <= 0:
+                    refused.add(coding)
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding)
+
+    for encoding in encodings:
+        encoding_bytes = encoding.encode()
+        if encoding_bytes in accepted or (b'*' in accepted and encoding_bytes not in refused):
+            return encoding
+
+
+class GzipCompressor:
+    __slots__ = ('_compressor',)
+
+    def __init__(self, level: int):
+        # wbits of MAX_WBITS | 16 gives a gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class BrotliCompressor:
+    __slots__ = ('_compressor',)
+
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class CompressionMiddleware:
+    """
+    Compress responses with brotli (if the "brotli" package is installed) or gzip depending on the request's
+    Accept-Encoding header.
+
+    Bodies are passed through an incremental compressor chunk by chunk and flushed after each chunk, so streaming
+    responses are compressed without being buffered. Strong ETags of compressed responses are made weak since the
+    body is no longer byte for byte the same. Responses are not compressed if:
+    * they already have a Content-Encoding, e.g. from PrecompressedStaticFiles
+    * their content type isn't compressible, e.g. images or event streams
+    * they're not streamed and the body is smaller than minimum_size bytes
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = 500,
+        gzip_level: int = 6,
+        brotli_quality: int = 4,
+        use_brotli: bool = True,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.encodings: Tuple[str, ...] = ('br', 'gzip') if use_brotli and brotli else ('gzip',)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        accept_encoding = get_header(scope, b'accept-encoding')
+        encoding = accept_encoding and choose_encoding(accept_encoding, self.encodings)
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+
+        # start message held until the first body message, so we know if the response is worth compressing
+        start_message: Optional[Message] = None
+        compressor = None
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal start_message, compressor
+            message_type = message['type']
+            if message_type == 'http.response.start':
+                if self.should_compress(message):
+                    start_message = message
+                else:
+                    await send(message)
+            elif message_type != 'http.response.body':
+                await send(message)
+            elif compressor is not None:
+                more_body = message.get('more_body', False)
+                body = compressor.compress(message.get('body', b''))
+                body += compressor.flush() if more_body else compressor.finish()
+                await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+            elif start_message is not None:
+                body = message.get('body', b'')
+                more_body = message.get('more_body', False)
+                if not more_body and len(body) < self.minimum_size:
+                    await send(start_message)
+                    await send(message)
+                    start_message = None
+                    return
+
+                compressor = self.compressor(encoding)
+                headers = MutableHeaders(scope=start_message)
+                headers['Content-Encoding'] = encoding
+                headers.add_vary_header('Accept-Encoding')
+                if (etag := headers.get('ETag')) and not etag.startswith('W/'):
+                    headers['ETag'] = f'W/{etag}'
+                body = compressor.compress(body)
+                if more_body:
+                    body += compressor.flush()
+                    del headers['Content-Length']
+                else:
+                    body += compressor.finish()
+                    headers['Content-Length'] = str(len(body))
+                await send(start_message)
+                start_message = None
+                await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+            else:
+                await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    def should_compress(self, message: Message) -> bool:
+        if message['status'] in skip_statuses:
+            return False
+        content_type = None
+        for key, value in message.get('headers', ()):
+            if key == b'content-encoding':
+                return False
+            elif key == b'content-type':
+                content_type = value
+        return content_type is not None and compressible_content_type.match(content_type) is not None
+
+    def compressor(self, encoding: str) -> Union[GzipCompressor, BrotliCompressor]:
+        if encoding == 'br':
+            return BrotliCompressor(self.brotli_quality)
+        else:
+            return GzipCompressor(self.gzip_level)
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    StaticFiles which serves "<file>.br" or "<file>.gz" instead of "<file>" if they exist and the client accepts
+    that encoding, e.g. when assets are compressed at build time.
+    """
+
+    encoding_extensions = ('br', '.br'), ('gzip', '.gz')
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        if scope['method'] in ('GET', 'HEAD') and (accept_encoding := get_header(scope, b'accept-encoding')):
+            found = await anyio.to_thread.run_sync(self.lookup_precompressed, path, accept_encoding)
+            if found:
+                encoding, full_path, compressed_path, stat_result = found
+                request_headers = Headers(scope=scope)
+                response = FileResponse(
+                    compressed_path,
+                    stat_result=stat_result,
+                    method=scope['method'],
+                    media_type=guess_type(full_path)[0] or 'text/plain',
+                    headers={'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'},
+                )
+                if self.is_not_modified(response.headers, request_headers):
+                    return NotModifiedResponse(response.headers)
+                return response
+
+        response = await super().get_response(path, scope)
+        response.headers.add_vary_header('Accept-Encoding')
+        return response
+
+    def lookup_precompressed(self, path: str, accept_encoding: bytes) -> Optional[Tuple[str, str, str, os.stat_result]]:
+        """
+        Find a compressed version of a file the client accepts, returns the encoding, the path of the original
+        file, the path of the compressed file and its stat result, or None.
+        """
+        full_path, stat_result = self.lookup_path(path)
+        if not stat_result or not stat.S_ISREG(stat_result.st_mode):
+            return None
+
+        for encoding, extension in self.encoding_extensions:
+            if choose_encoding(accept_encoding, (encoding,)):
+                compressed_path = full_path + extension
+                try:
+                    compressed_stat = os.stat(compressed_path)
+                except OSError:
+                    continue
+                if stat.S_ISREG(compressed_stat.st_mode):
+                    return encoding, full_path, compressed_path, compressed_stat
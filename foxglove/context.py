@@ -0,0 +1,149 @@
+import logging
+import re
+import secrets
+from contextvars import ContextVar
+from time import time
+from typing import Optional
+
+import httpx
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .utils import IP_HEADER, get_header, route_template, scope_request_start
+
+__all__ = (
+    'RequestContext',
+    'RequestContextMiddleware',
+    'RequestContextFilter',
+    'request_context',
+    'get_request_id',
+    'add_request_id_header',
+)
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+request_context: ContextVar[Optional['RequestContext']] = ContextVar('foxglove_request_context', default=None)
+# request IDs from clients are only used if they're reasonably short and can't mess up logs or headers
+valid_request_id = re.compile(rb'[\w.:+/=-]{1,200}')
+ip_header = IP_HEADER.lower().encode()
+
+
+class RequestContext:
+    """
+    Details of the request currently being handled, available anywhere via request_context.get(),
+    request_id, route, ip and start_time are only worked out when they're read.
+    """
+
+    __slots__ = 'scope', '_request_id', 'received_at'
+
+    def __init__(self, scope: Scope, request_id: Optional[str] = None, received_at: Optional[float] = None):
+        self.scope = scope
+        self._request_id = request_id
+        # when the app received the request
+        self.received_at = time() if received_at is None else received_at
+
+    @property
+    def request_id(self) -> str:
+        """
+        ID from the X-Request-ID header if it's set (e.g. by Heroku's router) and valid, otherwise a new ID.
+        """
+        if self._request_id is None:
+            raw_request_id = get_header(self.scope, b'x-request-id')
+            if raw_request_id and valid_request_id.fullmatch(raw_request_id):
+                self._request_id = raw_request_id.decode()
+            else:
+                self._request_id = secrets.token_hex(16)
+        return self._request_id
+
+    @property
+    def route(self) -> Optional[str]:
+        return route_template(self.scope)
+
+    @property
+    def ip(self) -> Optional[str]:
+        if ips := get_header(self.scope, ip_header):
+            return ips.split(b',', 1)[0].strip(b' ').decode('latin-1')
+        elif client := self.scope.get('client'):
+            return client[0]
+
+    @property
+    def start_time(self) -> float:
+        """
+        When the router received the request, from the X-Request-Start header, or when the app received it.
+        """
+        return scope_request_start(self.scope, self.received_at)
+
+    def __repr__(self):
+        return f'RequestContext(request_id={self.request_id!r}, route={self.route!r}, ip={self.ip!r})'
+
+
+def get_request_id() -> Optional[str]:
+    """
+    ID of the request currently being handled, None outside requests.
+    """
+    ctx = request_context.get()
+    return ctx and ctx.request_id
+
+
+class RequestContextMiddleware:
+    """
+    Set request_context for each request. The request ID is taken from the X-Request-ID header if it's set
+    (e.g. by Heroku's router) and valid, otherwise a new ID is generated, if response_header is True the ID is also
+    returned in the response's X-Request-ID header.
+
+    Nothing is parsed up front, the context only holds the raw scope and the request ID is read from its headers
+    the first time it's needed.
+
+    RequestContextFilter adds the context to log records, and add_request_id_header adds the request ID
+    to requests made with glove.http.
+    """
+
+    def __init__(self, app: ASGIApp, response_header: bool = True):
+        self.app = app
+        self.response_header = response_header
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        ctx = RequestContext(scope)
+        if self.response_header:
+
+            async def send_wrapper(message: Message) -> None:
+                if message['type'] == 'http.response.start':
+                    # cheaper than MutableHeaders, the request ID is already known to be a valid header value
+                    message['headers'] = [*message.get('headers', ()), (b'x-request-id', ctx.request_id.encode())]
+                await send(message)
+
+        else:
+            send_wrapper = send
+
+        token = request_context.set(ctx)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_context.reset(token)
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Add "request_id", "request_route", "request_ip" and "request_start" to log records created while handling a request,
+    this is added to foxglove's handlers by build_logging_config().
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        ctx = request_context.get()
+        if ctx is not None and not hasattr(record, 'request_id'):
+            record.request_id = ctx.request_id
+            record.request_route = ctx.route
+            record.request_ip = ctx.ip
+            record.request_start = ctx.start_time
+        return True
+
+
+async def add_request_id_header(request: httpx.Request) -> None:
+    """
+    httpx event hook to pass on the ID of the current request, used by glove.http.
+    """
+    ctx = request_context.get()
+    if ctx is not None and REQUEST_ID_HEADER not in request.headers:
+        request.headers[REQUEST_ID_HEADER] = ctx.request_id
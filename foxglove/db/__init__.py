@@ -1,4 +1,6 @@
 # flake8: noqa
 from .main import create_pg_pool, prepare_database, reset_database
-from .middleware import PgMiddleware
+from .middleware import AsgiPgMiddleware, PgMiddleware
+from .replica import ReplicaMonitor, create_pg_read_pool
+from .shards import HashRing, create_pg_shard_pools
 from .utils import lenient_conn
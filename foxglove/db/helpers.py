@@ -109,7 +109,7 @@ class DummyPgPool(_LockedExecute):
     Connection or BuildPgConnection, including locking before using the underlying connection.
     """
 
-    def acquire(self):
+    def acquire(self, *, timeout: Optional[float] = None):
         return _ConnAcquire(self._conn, self._lock, self._transaction_lock)
 
     async def close(self):
@@ -1,9 +1,28 @@
-from typing import TYPE_CHECKING
+import asyncio
+import logging
+from collections import defaultdict, deque
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Deque, Dict, Iterator, Optional, Union
 
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-__all__ = 'PgMiddleware', 'get_db'
+from ..exceptions import HttpBadRequest, HttpServiceUnavailable
+from .replica import ReplicaMonitor, read_pool_name, replica_errors
+from .shards import HashRing, shard_pool_name, shard_prefix
+
+__all__ = (
+    'PgMiddleware',
+    'AsgiPgMiddleware',
+    'get_db',
+    'get_db_streaming',
+    'get_db_read',
+    'get_db_by_method',
+    'get_db_for',
+    'pg_conn_sender',
+    'pool_stats',
+)
 
 if TYPE_CHECKING:
     from buildpg.asyncpg import BuildPgConnection
@@ -11,24 +30,203 @@ if TYPE_CHECKING:
 
     from ..middleware import CallNext
 
+logger = logging.getLogger('foxglove.db')
+
+
+class AcquireQueue:
+    """
+    Requests waiting for a connection from a pool, only the request at the front of the queue waits on the pool
+    itself so connections are handed out in the order requests asked for them.
+    """
+
+    __slots__ = ('waiters',)
+
+    def __init__(self):
+        self.waiters: Deque[asyncio.Future] = deque()
+
+    def __len__(self) -> int:
+        return len(self.waiters)
+
+    async def acquire(self, pool, timeout: Optional[float]):
+        """
+        Acquire a connection from pool, raises asyncio.TimeoutError if that takes longer than timeout.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        try:
+            if len(self.waiters) > 1:
+                start = perf_counter()
+                await asyncio.wait_for(future, timeout)
+                if timeout is not None:
+                    timeout = max(timeout - (perf_counter() - start), 0)
+            return await pool.acquire(timeout=timeout)
+        finally:
+            front = self.waiters[0] is future
+            self.waiters.remove(future)
+            if front and self.waiters and not self.waiters[0].done():
+                self.waiters[0].set_result(None)
+
+
+# requests waiting for a connection from each pool, by the pool's attribute name on glove
+acquire_queues: Dict[str, AcquireQueue] = defaultdict(AcquireQueue)
+
+
+def get_pool(glove, pool_name: str):
+    """
+    Get a pool by the name used by GetPgConn, either an attribute of glove or a shard in glove.pg_shards.
+    """
+    if pool_name.startswith(shard_prefix):
+        return getattr(glove, 'pg_shards', {}).get(pool_name[len(shard_prefix) :])
+    else:
+        return getattr(glove, pool_name, None)
+
+
+def pool_stats(glove, pool_name: str = 'pg') -> Optional[Dict[str, int]]:
+    """
+    Current size, idle connections, max size and number of requests waiting for a connection of a pool,
+    None if the pool doesn't exist or isn't an asyncpg pool.
+    """
+    pool = get_pool(glove, pool_name)
+    if pool is None or not hasattr(pool, 'get_size'):
+        return None
+    return dict(
+        size=pool.get_size(),
+        idle=pool.get_idle_size(),
+        max_size=pool.get_max_size(),
+        waiters=len(acquire_queues[pool_name]),
+    )
+
 
 class GetPgConn:
-    __slots__ = '_glove', '_conn'
+    """
+    Lazily acquire a connection for a request, the time spent waiting for and holding the connection
+    are recorded for logs and metrics.
+
+    If settings.pg_max_waiters requests are already waiting for a connection, or one isn't available within
+    settings.pg_acquire_timeout, HttpServiceUnavailable is raised so overloaded apps fail fast instead of
+    queueing requests indefinitely.
+    """
+
+    __slots__ = '_glove', 'pool_name', '_conn', 'keep', 'wait_time', '_hold_time', '_acquired_at', '_others'
 
-    def __init__(self, glove):
+    def __init__(self, glove, pool_name: str = 'pg'):
         self._glove = glove
+        # attribute name of the pool on glove
+        self.pool_name = pool_name
         self._conn = None
+        # if set, AsgiPgMiddleware keeps the connection until the response body has been sent
+        self.keep = False
+        # None if a connection was never acquired
+        self.wait_time: Optional[float] = None
+        self._hold_time = 0.0
+        self._acquired_at = 0.0
+        # connections from other pools used by the request, see for_pool()
+        self._others: Optional[Dict[str, GetPgConn]] = None
 
     async def __call__(self):
         if self._conn is None:
-            self._conn = await self._glove.pg.acquire()
+            settings = self._glove.settings
+            queue = acquire_queues[self.pool_name]
+            if settings.pg_max_waiters is not None and len(queue) >= settings.pg_max_waiters:
+                raise HttpServiceUnavailable('database busy', retry_after=settings.pg_retry_after)
+
+            start = perf_counter()
+            try:
+                self._conn = await queue.acquire(get_pool(self._glove, self.pool_name), settings.pg_acquire_timeout)
+            except asyncio.TimeoutError:
+                raise HttpServiceUnavailable('database busy', retry_after=settings.pg_retry_after)
+            self._acquired_at = perf_counter()
+            wait_time = self._acquired_at - start
+            self.wait_time = (self.wait_time or 0) + wait_time
+            if settings.pg_acquire_warning_time is not None and wait_time > settings.pg_acquire_warning_time:
+                logger.warning(
+                    'waited %0.0fms to acquire a database connection',
+                    wait_time * 1000,
+                    extra={'pool': pool_stats(self._glove, self.pool_name)},
+                )
         return self._conn
 
+    async def read(self):
+        """
+        Connection from the read replica, or the primary if there's no replica, the replica is down, lagging or too
+        busy to give a connection within settings.pg_acquire_timeout, or the request already has a connection to the
+        primary so it sees its own writes.
+        """
+        monitor: Optional[ReplicaMonitor] = getattr(self._glove, 'replica_monitor', None)
+        if self._conn is None and monitor is not None and monitor.healthy:
+            try:
+                return await self.for_pool(read_pool_name)()
+            except replica_errors as e:
+                monitor.mark_down(e)
+            except HttpServiceUnavailable:
+                # the replica is busy rather than down, so it's still used by other requests
+                pass
+        return await self()
+
+    def for_pool(self, pool_name: str) -> 'GetPgConn':
+        """
+        Lazy connection from another pool which is released along with this one.
+        """
+        if pool_name == self.pool_name:
+            return self
+        if self._others is None:
+            self._others = {}
+        other = self._others.get(pool_name)
+        if other is None:
+            other = self._others[pool_name] = GetPgConn(self._glove, pool_name)
+        return other
+
+    def for_shard(self, key: Any) -> 'GetPgConn':
+        """
+        Lazy connection to the shard for key, see glove.shard_ring.
+        """
+        shard_ring: Optional[HashRing] = getattr(self._glove, 'shard_ring', None)
+        if shard_ring is None:
+            raise RuntimeError('no database shards configured, set settings.pg_shards to use get_db_for')
+        return self.for_pool(shard_pool_name(shard_ring.node(key)))
+
+    def acquired(self) -> Iterator['GetPgConn']:
+        """
+        This and connections from other pools which have been acquired during the request.
+        """
+        if self.wait_time is not None:
+            yield self
+        if self._others:
+            yield from (other for other in self._others.values() if other.wait_time is not None)
+
     async def release(self):
         if self._conn is not None:
             conn = self._conn
             self._conn = None
-            await self._glove.pg.release(conn)
+            self._hold_time += perf_counter() - self._acquired_at
+            await get_pool(self._glove, self.pool_name).release(conn)
+        if self._others:
+            for other in self._others.values():
+                await other.release()
+
+    @property
+    def hold_time(self) -> float:
+        """
+        Total time the request has held a connection, including the current connection if it hasn't been released.
+        """
+        if self._conn is None:
+            return self._hold_time
+        else:
+            return self._hold_time + perf_counter() - self._acquired_at
+
+    def log_extra(self) -> Optional[Dict[str, Any]]:
+        """
+        Wait and hold times of connections used by the request by pool name, None if none were used.
+        """
+        extra = {
+            conn.pool_name: dict(
+                acquire_wait=f'{conn.wait_time * 1000:0.2f}ms',
+                hold=f'{conn.hold_time * 1000:0.2f}ms',
+                pool=pool_stats(conn._glove, conn.pool_name),
+            )
+            for conn in self.acquired()
+        }
+        return extra or None
 
 
 class PgMiddleware(BaseHTTPMiddleware):
@@ -47,5 +245,97 @@ class PgMiddleware(BaseHTTPMiddleware):
             await request.state.get_pg_conn.release()
 
 
+class AsgiPgMiddleware:
+    """
+    Pure ASGI equivalent of PgMiddleware which releases the connection (if one was acquired) as soon as the response
+    starts, before it's sent to the client.
+
+    Views which use the connection after that, e.g. streaming responses which read from the database or background
+    tasks, should use get_db_streaming instead of get_db, the connection is then released once the app has returned,
+    after the response body has been sent and background tasks have run.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+        from ..main import glove
+
+        self.glove = glove
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        scope.setdefault('state', {})['get_pg_conn'] = get_pg_conn = GetPgConn(self.glove)
+        try:
+            await self.app(scope, receive, pg_conn_sender(get_pg_conn, send))
+        finally:
+            await get_pg_conn.release()
+
+
+def pg_conn_sender(get_pg_conn: GetPgConn, send: Send) -> Send:
+    """
+    Wrap send to release the connection when the response starts unless get_pg_conn.keep is set, in which case
+    the caller must release it once the app has returned.
+    """
+
+    async def send_wrapper(message: Message) -> None:
+        if message['type'] == 'http.response.start' and not get_pg_conn.keep:
+            await get_pg_conn.release()
+        await send(message)
+
+    return send_wrapper
+
+
 async def get_db(request: Request) -> 'BuildPgConnection':
     return await request.state.get_pg_conn()
+
+
+async def get_db_streaming(request: Request) -> 'BuildPgConnection':
+    """
+    Like get_db, but with AsgiPgMiddleware or FoxgloveStack the connection is kept until the app has returned,
+    so it can be used by streaming responses and background tasks, rather than released when the response starts.
+    """
+    get_pg_conn: GetPgConn = request.state.get_pg_conn
+    get_pg_conn.keep = True
+    return await get_pg_conn()
+
+
+async def get_db_read(request: Request) -> 'BuildPgConnection':
+    """
+    Connection to the read replica at settings.pg_read_dsn, falling back to the primary, see GetPgConn.read.
+    """
+    return await request.state.get_pg_conn.read()
+
+
+async def get_db_by_method(request: Request) -> 'BuildPgConnection':
+    """
+    Connection to the read replica for GET, HEAD and OPTIONS requests, otherwise the primary.
+    """
+    if request.method in ('GET', 'HEAD', 'OPTIONS'):
+        return await request.state.get_pg_conn.read()
+    else:
+        return await request.state.get_pg_conn()
+
+
+def get_db_for(key: Union[str, Callable[[Request], Any]]) -> Callable[[Request], Awaitable['BuildPgConnection']]:
+    """
+    Create a dependency which gets a connection to the shard (from settings.pg_shards) for a key, where key is either
+    the name of a path or query parameter or a function which takes the request, e.g.
+
+        @app.get('/{tenant_id}/users/')
+        async def users(conn=Depends(get_db_for('tenant_id'))):
+            ...
+    """
+
+    async def get_shard_db(request: Request) -> 'BuildPgConnection':
+        if callable(key):
+            shard_key = key(request)
+        else:
+            shard_key = request.path_params.get(key, request.query_params.get(key))
+            if shard_key is None:
+                raise HttpBadRequest(f'"{key}" is required')
+        return await request.state.get_pg_conn.for_shard(shard_key)()
+
+    return get_shard_db
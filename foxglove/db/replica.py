@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from typing import TYPE_CHECKING, Optional
+
+from asyncpg import CannotConnectNowError, InterfaceError, PostgresConnectionError, PostgresError
+from buildpg.asyncpg import BuildPgPool, create_pool_b
+
+from ..context import request_context
+from ..settings import BaseSettings
+
+if TYPE_CHECKING:
+    from ..main import Glove
+
+__all__ = 'ReplicaMonitor', 'create_pg_read_pool'
+
+logger = logging.getLogger('foxglove.db')
+
+# name of the read replica's pool on glove
+read_pool_name = 'pg_read'
+# errors which mean the replica is down rather than a problem with a query
+replica_errors = OSError, PostgresConnectionError, CannotConnectNowError, InterfaceError
+# seconds since the last replayed transaction, or 0 if the replica has replayed everything it has received
+# (or isn't a replica), so replicas of idle databases don't appear to be lagging
+lag_sql = """
+select case
+  when pg_is_in_recovery() and pg_last_wal_receive_lsn() is distinct from pg_last_wal_replay_lsn()
+  then coalesce(extract(epoch from now() - pg_last_xact_replay_timestamp()), 0)::float
+  else 0
+end
+"""
+
+
+async def create_pg_read_pool(settings: BaseSettings) -> BuildPgPool:
+    """
+    Create a pool for the read replica at settings.pg_read_dsn, connections are only made when they're first
+    used so the app can start while the replica is down.
+    """
+    return await create_pool_b(
+        settings.pg_read_dsn,
+        min_size=0,
+        max_size=settings.pg_pool_max_size,
+        server_settings=settings.pg_server_settings,
+    )
+
+
+class ReplicaMonitor:
+    """
+    Checks whether the read replica is up and its replication lag is below settings.pg_read_max_lag every
+    settings.pg_read_check_interval seconds, get_db_read uses the primary while it isn't.
+    """
+
+    def __init__(self, glove: 'Glove'):
+        self.glove = glove
+        self.healthy = True
+        # replication lag in seconds from the last successful check
+        self.lag: Optional[float] = None
+        self._loop_task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._loop_task is None:
+            self._loop_task = asyncio.create_task(self._check_loop())
+
+    async def stop(self) -> None:
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            try:
+                await self._loop_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._loop_task = None
+
+    async def check(self) -> bool:
+        settings = self.glove.settings
+        try:
+            async with self.glove.pg_read.acquire(timeout=settings.pg_read_check_interval) as conn:
+                self.lag = lag = await conn.fetchval(lag_sql)
+        except (asyncio.TimeoutError, PostgresError, *replica_errors) as e:
+            self.set_healthy(False, f'{e.__class__.__name__}: {e}')
+        else:
+            max_lag = settings.pg_read_max_lag
+            self.set_healthy(max_lag is None or lag <= max_lag, f'replication lag {lag:0.1f}s')
+        return self.healthy
+
+    def mark_down(self, exc: Exception) -> None:
+        """
+        Called when acquiring a connection from the replica fails, it's used again once a check succeeds.
+        """
+        self.set_healthy(False, f'{exc.__class__.__name__}: {exc}')
+
+    def set_healthy(self, healthy: bool, reason: str) -> None:
+        if healthy and not self.healthy:
+            logger.info('read replica available, %s', reason)
+        elif not healthy and self.healthy:
+            logger.warning('read replica unavailable, using the primary for reads, %s', reason)
+        self.healthy = healthy
+
+    async def _check_loop(self) -> None:
+        # this task may have been started during a request, its logs shouldn't be attributed to that request
+        request_context.set(None)
+        while True:
+            try:
+                await self.check()
+            except Exception:
+                logger.exception('error checking read replica')
+            await asyncio.sleep(self.glove.settings.pg_read_check_interval)
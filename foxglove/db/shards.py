@@ -0,0 +1,67 @@
+import hashlib
+from bisect import bisect_right
+from typing import Any, Dict, Iterable, List
+
+from buildpg.asyncpg import BuildPgPool, create_pool_b
+
+from ..settings import BaseSettings
+from .utils import gather_pools
+
+__all__ = 'HashRing', 'create_pg_shard_pools', 'shard_pool_name'
+
+# prefix of the pool names GetPgConn uses for shards, the pools themselves are in glove.pg_shards
+shard_prefix = 'pg_shards:'
+
+
+def shard_pool_name(shard: str) -> str:
+    return f'{shard_prefix}{shard}'
+
+
+def ring_hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping keys to nodes, e.g. tenant IDs to shards.
+
+    Each node is placed at virtual_nodes points on the ring so keys are spread evenly, adding or removing a node
+    only moves the keys which map to that node. Keys are converted to strings, so 123 and '123' map to the same node.
+    """
+
+    __slots__ = 'nodes', '_points', '_point_nodes'
+
+    def __init__(self, nodes: Iterable[str], virtual_nodes: int = 100):
+        self.nodes: List[str] = list(nodes)
+        points = sorted((ring_hash(f'{node}#{i}'), node) for node in self.nodes for i in range(virtual_nodes))
+        self._points = [point for point, _ in points]
+        self._point_nodes = [node for _, node in points]
+
+    def node(self, key: Any) -> str:
+        """
+        Find the node for a key, the first node clockwise from the key's hash.
+        """
+        if not self._points:
+            raise ValueError('hash ring has no nodes')
+        i = bisect_right(self._points, ring_hash(str(key)))
+        return self._point_nodes[i % len(self._points)]
+
+    def __repr__(self) -> str:
+        return f'HashRing({self.nodes})'
+
+
+async def create_pg_shard_pools(settings: BaseSettings) -> Dict[str, BuildPgPool]:
+    """
+    Create pools for the databases in settings.pg_shards concurrently, if any fail, the others are closed.
+    """
+    shards = settings.pg_shards
+    pools = await gather_pools(
+        create_pool_b(
+            dsn,
+            min_size=settings.pg_pool_min_size,
+            max_size=settings.pg_pool_max_size,
+            server_settings=settings.pg_server_settings,
+        )
+        for dsn in shards.values()
+    )
+    return dict(zip(shards, pools))
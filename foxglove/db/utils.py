@@ -1,6 +1,6 @@
 import asyncio
 import logging
-from typing import Optional
+from typing import Any, Awaitable, Iterable, List, Optional
 
 from async_timeout import timeout
 from asyncpg import PostgresError
@@ -8,7 +8,7 @@ from buildpg.asyncpg import BuildPgConnection, connect_b
 
 from ..settings import BaseSettings
 
-__all__ = 'AsyncPgContext', 'lenient_conn'
+__all__ = 'AsyncPgContext', 'lenient_conn', 'gather_pools'
 
 logger = logging.getLogger('foxglove.db')
 
@@ -47,3 +47,20 @@ async def lenient_conn(settings: BaseSettings, *, with_db: bool = True, sleep: f
             log = logger.debug if retry == 8 else logger.info
             log('pg connection successful, version: %s', await conn.fetchval('SELECT version()'))
             return conn
+
+
+async def gather_pools(coros: Iterable[Awaitable[Any]]) -> List[Any]:
+    """
+    Create pools concurrently, if any fail, the pools which were created are closed and the first error is raised.
+
+    Each coroutine may return a pool or a dict of pools.
+    """
+    results = await asyncio.gather(*coros, return_exceptions=True)
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        pools = [
+            p for r in results if not isinstance(r, BaseException) for p in (r.values() if isinstance(r, dict) else [r])
+        ]
+        await asyncio.gather(*[pool.close() for pool in pools])
+        raise errors[0]
+    return results
@@ -0,0 +1,107 @@
+import zlib
+from typing import Callable, Optional, TypeVar
+
+from starlette.datastructures import Headers
+from starlette.staticfiles import NotModifiedResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .utils import get_header
+
+__all__ = 'ETagMiddleware', 'etag', 'weak_etag', 'etag_matches'
+
+etag_attribute = 'foxglove_etag'
+T = TypeVar('T', bound=Callable)
+
+
+def etag(view: T) -> T:
+    """
+    Mark a view so ETagMiddleware adds an ETag to its responses and answers matching conditional requests with 304.
+    """
+    setattr(view, etag_attribute, True)
+    return view
+
+
+def weak_etag(body: bytes) -> bytes:
+    """
+    Weak ETag from a CRC32 of the body and its length, this is much faster than a cryptographic hash and
+    collisions only matter for consecutive versions of the same resource.
+    """
+    return b'W/"%08x-%x"' % (zlib.crc32(body), len(body))
+
+
+def etag_matches(if_none_match: bytes, etag_value: bytes) -> bool:
+    """
+    Whether an If-None-Match header matches an ETag, using the weak comparison required for If-None-Match.
+    """
+    if if_none_match.strip() == b'*':
+        return True
+    opaque_tag = etag_value[2:] if etag_value.startswith(b'W/') else etag_value
+    for tag in if_none_match.split(b','):
+        tag = tag.strip()
+        if tag.startswith(b'W/'):
+            tag = tag[2:]
+        if tag == opaque_tag:
+            return True
+    return False
+
+
+class ETagMiddleware:
+    """
+    Add weak ETags to successful GET and HEAD responses of views marked with @etag, or all views if all_routes
+    is True, and respond with 304 Not Modified if the request's If-None-Match header matches.
+
+    The response is still generated, but the body isn't sent to clients which already have it. Streaming responses
+    and responses which already have an ETag are left unchanged. If CompressionMiddleware is used, add it before
+    (outside) this middleware so ETags are calculated from the uncompressed body.
+    """
+
+    def __init__(self, app: ASGIApp, all_routes: bool = False):
+        self.app = app
+        self.all_routes = all_routes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or scope['method'] not in ('GET', 'HEAD'):
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Optional[Message] = None
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal start_message
+            if message['type'] == 'http.response.start':
+                if message['status'] == 200 and self.route_enabled(scope) and not has_etag(message):
+                    # wait for the body before sending the start message
+                    start_message = message
+                else:
+                    await send(message)
+            elif start_message is None or message['type'] != 'http.response.body':
+                await send(message)
+            else:
+                start, start_message = start_message, None
+                if message.get('more_body', False):
+                    # streaming response, we can't know the ETag before the headers are sent
+                    await send(start)
+                    await send(message)
+                    return
+
+                etag_value = weak_etag(message.get('body', b''))
+                if_none_match = get_header(scope, b'if-none-match')
+                headers = [*start.get('headers', ()), (b'etag', etag_value)]
+                if if_none_match and etag_matches(if_none_match, etag_value):
+                    await NotModifiedResponse(Headers(raw=headers))(scope, receive, send)
+                else:
+                    start['headers'] = headers
+                    await send(start)
+                    await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    def route_enabled(self, scope: Scope) -> bool:
+        if self.all_routes:
+            return True
+        endpoint = getattr(scope.get('route'), 'endpoint', None)
+        return getattr(endpoint, etag_attribute, False)
+
+
+def has_etag(message: Message) -> bool:
+    return any(key == b'etag' for key, _ in message.get('headers', ()))
@@ -26,6 +26,7 @@ __all__ = (
     'HttpConflict',
     'HttpUnprocessableEntity',
     'HttpTooManyRequests',
+    'HttpServiceUnavailable',
     'Http470',
     'manual_response_error',
     'UnexpectedResponse',
@@ -125,6 +126,16 @@ class HttpTooManyRequests(HttpMessageError):
     status = 429
 
 
+class HttpServiceUnavailable(HttpMessageError):
+    status = 503
+
+    def __init__(self, message, *, retry_after: Optional[int] = None, details=None, headers=None):
+        headers = dict(headers or {})
+        if retry_after is not None:
+            headers.setdefault('Retry-After', str(retry_after))
+        super().__init__(message, details=details, headers=headers)
+
+
 class Http470(HttpMessageError):
     status = 470
     custom_reason = 'Invalid user input'
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import logging.config
 import os
@@ -5,10 +6,12 @@ import traceback
 from copy import copy
 from functools import lru_cache
 from io import StringIO
-from typing import Any, Dict
+from time import time
+from typing import Any, Awaitable, Callable, Dict, Optional
 
 from uvicorn.logging import DefaultFormatter
 
+from .context import request_context
 from .main import glove
 
 try:
@@ -102,6 +105,87 @@ def get_env_multiple(*names):
             return v
 
 
+class LogQueue:
+    """
+    Bounded queue of logging jobs run by a background task, used by ErrorMiddleware and AsgiErrorMiddleware
+    when settings.log_in_background is set so formatting log records and building sentry events doesn't delay
+    responses.
+
+    When the queue is full, jobs are dropped and counted in "dropped", a warning is logged at most once
+    every overflow_warning_interval seconds. Remaining jobs are run by close() which is called by glove.shutdown().
+    """
+
+    overflow_warning_interval = 60
+
+    def __init__(self, max_size: int):
+        self.dropped = 0
+        self._queue: 'asyncio.Queue[Any]' = asyncio.Queue(max_size)
+        self._task: Optional[asyncio.Task] = None
+        self._last_overflow_warning = 0.0
+        self._dropped_since_warning = 0
+
+    def put(self, func: Callable[..., Awaitable[Any]], *args: Any) -> bool:
+        """
+        Add a job to the queue, returns False if the queue is full and the job was dropped.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+        try:
+            self._queue.put_nowait((func, args, request_context.get()))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            self._dropped_since_warning += 1
+            now = time()
+            if now - self._last_overflow_warning > self.overflow_warning_interval:
+                logger.warning(
+                    'log queue full, %d jobs dropped (%d total)',
+                    self._dropped_since_warning,
+                    self.dropped,
+                    extra={'queue_size': self._queue.maxsize},
+                )
+                self._last_overflow_warning = now
+                self._dropped_since_warning = 0
+            return False
+        else:
+            return True
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    async def close(self, timeout: float = 10) -> None:
+        """
+        Wait for queued jobs to be run, then stop the background task.
+        """
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning('timed out waiting for log queue to drain, %d jobs not run', len(self))
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self.dropped:
+            logger.warning('log queue closed, %d jobs were dropped', self.dropped)
+
+    async def _run(self) -> None:
+        while True:
+            func, args, ctx = await self._queue.get()
+            # the task copied the context of whichever request started it, use the context of the request
+            # which queued this job instead so logs have the right request ID
+            request_context.set(ctx)
+            try:
+                await func(*args)
+            except Exception:
+                logger.exception('error running background logging job')
+            finally:
+                self._queue.task_done()
+
+
 @lru_cache
 def setup_sentry() -> bool:
     if glove.settings.sentry_dsn:
@@ -142,18 +226,23 @@ def build_logging_config() -> Dict[str, Any]:
                 'fmt': "%(levelprefix)s %(client_addr)s - '%(request_line)s' %(status_code)s",
             },
         },
+        'filters': {
+            'foxglove.request_context': {'()': 'foxglove.context.RequestContextFilter'},
+        },
         'handlers': {
             'foxglove.default': {
                 'formatter': 'foxglove.default',
                 'class': 'logging.StreamHandler',
                 'stream': 'ext://sys.stderr',
                 'level': log_level,
+                'filters': ['foxglove.request_context'],
             },
             'foxglove.access': {
                 'formatter': 'foxglove.access',
                 'class': 'logging.StreamHandler',
                 'stream': 'ext://sys.stdout',
                 'level': log_level,
+                'filters': ['foxglove.request_context'],
             },
         },
         'loggers': {
@@ -1,7 +1,8 @@
 import asyncio
 import os
 from contextlib import asynccontextmanager
-from typing import Literal
+from functools import partial
+from typing import TYPE_CHECKING, Dict, Literal
 
 import arq
 import httpx
@@ -10,16 +11,30 @@ from fastapi import FastAPI
 from pydantic_settings import BaseSettings as PydanticBaseSettings
 from uvicorn.importer import ImportFromStringError, import_from_string
 
-from .db import create_pg_pool
+from .context import add_request_id_header
+from .db import HashRing, ReplicaMonitor, create_pg_pool, create_pg_read_pool, create_pg_shard_pools
+from .db.utils import gather_pools
 from .settings import BaseSettings
 
+if TYPE_CHECKING:
+    from .cloudflare import CloudflareIPs
+    from .logs import LogQueue
+    from .metrics import Metrics
+
 __all__ = ('glove',)
 
 
 class Glove:
     _settings: BaseSettings
     _http: httpx.AsyncClient
+    _cloudflare_ips: 'CloudflareIPs'
+    _log_queue: 'LogQueue'
+    _metrics: 'Metrics'
     pg: BuildPgPool
+    pg_read: BuildPgPool
+    replica_monitor: ReplicaMonitor
+    pg_shards: Dict[str, BuildPgPool]
+    shard_ring: HashRing
     redis: arq.ArqRedis
 
     @asynccontextmanager
@@ -36,24 +51,78 @@ class Glove:
         if run_migrations == 'unless-test-mode':
             run_migrations = not self.settings.test_mode
 
-        if not hasattr(self, 'pg'):
-            self.pg = await create_pg_pool(self.settings, run_migrations=run_migrations)
+        await self._create_pools(run_migrations)
+        if hasattr(self, 'pg_read') and not hasattr(self, 'replica_monitor'):
+            self.replica_monitor = ReplicaMonitor(self)
+            self.replica_monitor.start()
+        if hasattr(self, 'pg_shards') and not hasattr(self, 'shard_ring'):
+            self.shard_ring = HashRing(self.pg_shards, self.settings.pg_shard_virtual_nodes)
         if not hasattr(self, 'redis') and self.settings.redis_settings:
             self.redis = await arq.create_pool(self.settings.redis_settings)
+        if self.settings.cloudflare_check:
+            # accessing the property loads the IP ranges and starts the refresh task
+            self.cloudflare_ips
+
+    async def _create_pools(self, run_migrations: bool) -> None:
+        """
+        Create the database pools which don't exist yet concurrently, if any fail, the others are closed.
+        """
+        settings = self.settings
+        coros = {}
+        if not hasattr(self, 'pg'):
+            coros['pg'] = create_pg_pool(settings, run_migrations=run_migrations)
+        if not hasattr(self, 'pg_read') and settings.pg_read_dsn:
+            coros['pg_read'] = create_pg_read_pool(settings)
+        if not hasattr(self, 'pg_shards') and settings.pg_shards:
+            coros['pg_shards'] = create_pg_shard_pools(settings)
+
+        results = await gather_pools(coros.values())
+        for name, result in zip(coros, results):
+            setattr(self, name, result)
 
     def context(self) -> 'GloveContext':
         return GloveContext(self)
 
     async def shutdown(self) -> None:
+        from .middleware import stop_warning_samplers
+
+        # log the final summaries of suppressed request warnings
+        await stop_warning_samplers()
+        if log_queue := getattr(self, '_log_queue', None):
+            # drain first since logging jobs might use other resources
+            await log_queue.close()
+            del self._log_queue
+
         coros = []
+        if metrics := getattr(self, '_metrics', None):
+            coros.append(metrics.stop())
+        if cloudflare_ips := getattr(self, '_cloudflare_ips', None):
+            coros.append(cloudflare_ips.stop())
+        if replica_monitor := getattr(self, 'replica_monitor', None):
+            coros.append(replica_monitor.stop())
         if pg := getattr(self, 'pg', None):
             coros.append(pg.close())
+        if pg_read := getattr(self, 'pg_read', None):
+            coros.append(pg_read.close())
+        if pg_shards := getattr(self, 'pg_shards', None):
+            coros += [pool.close() for pool in pg_shards.values()]
         if http := getattr(self, '_http', None):
             coros.append(http.aclose())
         if redis := getattr(self, 'redis', None):
             coros.append(redis.close(close_connection_pool=True))
         await asyncio.gather(*coros)
-        for prop in 'pg', '_http', 'redis':
+        props = (
+            'pg',
+            'pg_read',
+            'replica_monitor',
+            'pg_shards',
+            'shard_ring',
+            '_http',
+            'redis',
+            '_cloudflare_ips',
+            '_metrics',
+        )
+        for prop in props:
             if hasattr(self, prop):
                 delattr(self, prop)
 
@@ -61,9 +130,43 @@ class Glove:
     def http(self) -> httpx.AsyncClient:
         http = getattr(self, '_http', None)
         if http is None:
-            http = self._http = httpx.AsyncClient(timeout=self.settings.http_client_timeout)
+            http = self._http = httpx.AsyncClient(
+                timeout=self.settings.http_client_timeout, event_hooks={'request': [add_request_id_header]}
+            )
         return http
 
+    @property
+    def cloudflare_ips(self) -> 'CloudflareIPs':
+        cloudflare_ips = getattr(self, '_cloudflare_ips', None)
+        if cloudflare_ips is None:
+            from .cloudflare import CloudflareIPs
+
+            cloudflare_ips = self._cloudflare_ips = CloudflareIPs(self.settings)
+            cloudflare_ips.start()
+        return cloudflare_ips
+
+    @property
+    def log_queue(self) -> 'LogQueue':
+        log_queue = getattr(self, '_log_queue', None)
+        if log_queue is None:
+            from .logs import LogQueue
+
+            log_queue = self._log_queue = LogQueue(self.settings.log_queue_size)
+        return log_queue
+
+    @property
+    def metrics(self) -> 'Metrics':
+        metrics = getattr(self, '_metrics', None)
+        if metrics is None:
+            from .db.middleware import pool_stats
+            from .metrics import Metrics
+
+            metrics = self._metrics = Metrics(
+                self.settings.metrics_dir, self.settings.metrics_write_interval, pool_stats=partial(pool_stats, self)
+            )
+            metrics.start()
+        return metrics
+
     @property
     def settings(self) -> BaseSettings:
         settings = getattr(self, '_settings', None)
@@ -0,0 +1,384 @@
+import asyncio
+import json
+import logging
+import os
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+from time import perf_counter, time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .context import request_context
+from .utils import get_header, route_template
+
+logger = logging.getLogger('foxglove.metrics')
+
+__all__ = 'Histogram', 'RouteMetrics', 'Metrics', 'MetricsMiddleware'
+
+# upper bounds in seconds of histogram buckets, there's also an implicit +Inf bucket
+default_buckets = 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+# label used for requests which didn't match a route, so raw paths never become labels
+unmatched_route = '<unmatched>'
+# methods are sent by the client, any others are recorded as other_method so they can't become unbounded labels
+known_methods = frozenset({'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'})
+other_method = 'other'
+content_type = 'text/plain; version=0.0.4'
+pool_stat_help = {
+    'size': 'Connections in the database pool.',
+    'idle': 'Idle connections in the database pool.',
+    'max_size': 'Maximum size of the database pool.',
+    'waiters': 'Requests waiting to acquire a database connection.',
+}
+
+
+class Histogram:
+    """
+    Histogram of durations, counts are stored per bucket (not cumulatively) in a preallocated array.
+    """
+
+    __slots__ = 'buckets', 'counts', 'sum'
+
+    def __init__(self, buckets: Sequence[float] = default_buckets):
+        self.buckets = buckets
+        self.counts = array('Q', [0]) * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def dump(self) -> List[float]:
+        return [*self.counts, self.sum]
+
+    def load(self, data: List[float]) -> None:
+        """
+        Add the counts from dump() of another histogram with the same buckets.
+        """
+        *counts, sum_ = data
+        for i, c in enumerate(counts):
+            self.counts[i] += int(c)
+        self.sum += sum_
+
+
+class RouteMetrics:
+    __slots__ = 'queue', 'handler', 'pg_wait', 'pg_hold', 'statuses'
+
+    def __init__(self, buckets: Sequence[float] = default_buckets):
+        # time between the router receiving the request (from X-Request-Start) and the app receiving it
+        self.queue = Histogram(buckets)
+        # time taken by the app to handle the request
+        self.handler = Histogram(buckets)
+        # time requests which used the database waited for and held a connection, see GetPgConn
+        self.pg_wait = Histogram(buckets)
+        self.pg_hold = Histogram(buckets)
+        self.statuses: Dict[int, int] = {}
+
+    def dump(self) -> Dict[str, Any]:
+        return {
+            'queue': self.queue.dump(),
+            'handler': self.handler.dump(),
+            'pg_wait': self.pg_wait.dump(),
+            'pg_hold': self.pg_hold.dump(),
+            'statuses': self.statuses,
+        }
+
+    def load(self, data: Dict[str, Any]) -> None:
+        self.queue.load(data['queue'])
+        self.handler.load(data['handler'])
+        self.pg_wait.load(data['pg_wait'])
+        self.pg_hold.load(data['pg_hold'])
+        for status, count in data['statuses'].items():
+            status = int(status)
+            self.statuses[status] = self.statuses.get(status, 0) + count
+
+
+class Metrics:
+    """
+    Request metrics for this process, used by MetricsMiddleware via glove.metrics.
+
+    If metrics_dir is set (from settings.metrics_dir), each process writes its metrics to "<metrics_dir>/<pid>.json"
+    every write_interval seconds, and render() aggregates the metrics of all processes, this means "/metrics"
+    shows the same numbers whichever uvicorn worker handles the request.
+
+    Files which haven't been written for 3 write intervals are from processes which have stopped or crashed,
+    they're ignored by render() and deleted by start(). Counters are the sum across the live processes, so when a
+    process stops they go down, Prometheus treats a decrease as a counter reset and rate() etc. handle it the same
+    way as a restart.
+    """
+
+    def __init__(
+        self,
+        metrics_dir: Optional[Path] = None,
+        write_interval: int = 10,
+        buckets: Sequence[float] = default_buckets,
+        pool_stats: Optional[Callable[[], Optional[Dict[str, int]]]] = None,
+    ):
+        self.buckets = buckets
+        self.routes: Dict[Tuple[str, str], RouteMetrics] = {}
+        self.in_flight = 0
+        # returns the current stats of the database pool, see foxglove.db.middleware.pool_stats
+        self.pool_stats = pool_stats
+        # sum of the pool stats of all processes, only set by aggregate()
+        self.pg_pool: Optional[Dict[str, int]] = None
+        self.metrics_dir = metrics_dir
+        self.write_interval = write_interval
+        self._write_task: Optional[asyncio.Task] = None
+
+    def route(self, method: str, template: str) -> RouteMetrics:
+        key = method, template
+        route_metrics = self.routes.get(key)
+        if route_metrics is None:
+            route_metrics = self.routes[key] = RouteMetrics(self.buckets)
+        return route_metrics
+
+    def dump(self) -> Dict[str, Any]:
+        return {
+            'in_flight': self.in_flight,
+            'pg_pool': self.pool_stats and self.pool_stats(),
+            'routes': [[method, template, m.dump()] for (method, template), m in self.routes.items()],
+        }
+
+    def load(self, data: Dict[str, Any]) -> None:
+        """
+        Add the metrics from dump() of another process.
+        """
+        self.in_flight += data['in_flight']
+        if pg_pool := data['pg_pool']:
+            if self.pg_pool is None:
+                self.pg_pool = dict(pg_pool)
+            else:
+                for k, v in pg_pool.items():
+                    self.pg_pool[k] = self.pg_pool.get(k, 0) + v
+        for method, template, route_data in data['routes']:
+            self.route(method, template).load(route_data)
+
+    def start(self) -> None:
+        """
+        Start writing metrics to metrics_dir in the background, this requires a running event loop.
+        """
+        if self.metrics_dir and self._write_task is None:
+            self.metrics_dir.mkdir(parents=True, exist_ok=True)
+            self.remove_stale()
+            self._write_task = asyncio.create_task(self._write_loop())
+
+    async def stop(self) -> None:
+        if self._write_task is not None:
+            self._write_task.cancel()
+            try:
+                await self._write_task
+            except asyncio.CancelledError:
+                pass
+            self._write_task = None
+            self.path.unlink(missing_ok=True)
+
+    @property
+    def path(self) -> Path:
+        return self.metrics_dir / f'{os.getpid()}.json'
+
+    @property
+    def stale_mtime(self) -> float:
+        """
+        Files last modified before this are from processes which have stopped.
+        """
+        return time() - self.write_interval * 3
+
+    def write(self) -> None:
+        tmp_path = self.path.with_name(f'.{self.path.name}.tmp')
+        tmp_path.write_text(json.dumps(self.dump()))
+        os.replace(tmp_path, self.path)
+
+    def remove_stale(self) -> None:
+        """
+        Delete the files of processes which have stopped or crashed without removing their file, and temporary
+        files they left behind.
+        """
+        min_mtime = self.stale_mtime
+        for path in [*self.metrics_dir.glob('*.json'), *self.metrics_dir.glob('.*.json.tmp')]:
+            try:
+                if path.stat().st_mtime < min_mtime:
+                    path.unlink()
+            except OSError as e:
+                logger.warning('error removing stale metrics file "%s", %s: %s', path, e.__class__.__name__, e)
+
+    def aggregate(self, data: Optional[Dict[str, Any]] = None) -> 'Metrics':
+        """
+        Metrics of all processes writing to metrics_dir, processes which haven't written their metrics
+        recently are assumed to have stopped and are ignored.
+
+        data is dump() of this process, it's taken when aggregate is called if not given.
+        """
+        total = Metrics(buckets=self.buckets)
+        total.load(self.dump() if data is None else data)
+        if not self.metrics_dir:
+            return total
+
+        min_mtime = self.stale_mtime
+        own_path = self.path
+        for path in self.metrics_dir.glob('*.json'):
+            if path == own_path:
+                continue
+            try:
+                if path.stat().st_mtime < min_mtime:
+                    continue
+                total.load(json.loads(path.read_bytes()))
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning('error reading metrics file "%s", %s: %s', path, e.__class__.__name__, e)
+        return total
+
+    async def render_async(self) -> str:
+        """
+        render() with the files of other processes read and parsed in a thread, so serving metrics doesn't
+        block the event loop.
+        """
+        return await run_in_threadpool(self.render, self.dump())
+
+    def render(self, data: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Render metrics in the Prometheus text exposition format, see aggregate() for data.
+        """
+        metrics = self.aggregate(data)
+        lines = [
+            '# HELP foxglove_requests_in_flight Requests currently being handled.',
+            '# TYPE foxglove_requests_in_flight gauge',
+            f'foxglove_requests_in_flight {metrics.in_flight}',
+        ]
+        routes = sorted(metrics.routes.items())
+        lines += render_histograms(
+            'foxglove_request_queue_seconds',
+            'Time between the router receiving requests and the app receiving them, from X-Request-Start.',
+            ((key, m.queue) for key, m in routes),
+        )
+        lines += render_histograms(
+            'foxglove_request_handler_seconds',
+            'Time taken by the app to handle requests.',
+            ((key, m.handler) for key, m in routes),
+        )
+        lines += render_histograms(
+            'foxglove_pg_acquire_seconds',
+            'Time requests waited to acquire a database connection.',
+            ((key, m.pg_wait) for key, m in routes),
+        )
+        lines += render_histograms(
+            'foxglove_pg_hold_seconds',
+            'Time requests held a database connection.',
+            ((key, m.pg_hold) for key, m in routes),
+        )
+        if metrics.pg_pool:
+            for stat, help_ in pool_stat_help.items():
+                lines += [
+                    f'# HELP foxglove_pg_pool_{stat} {help_}',
+                    f'# TYPE foxglove_pg_pool_{stat} gauge',
+                    f'foxglove_pg_pool_{stat} {metrics.pg_pool[stat]}',
+                ]
+        lines += [
+            '# HELP foxglove_requests_total Requests by route and response status.',
+            '# TYPE foxglove_requests_total counter',
+        ]
+        for (method, template), m in routes:
+            labels = route_labels(method, template)
+            for status, count in sorted(m.statuses.items()):
+                lines.append(f'foxglove_requests_total{{{labels},status="{status}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+    async def _write_loop(self) -> None:
+        # don't keep the context of the request which happened to access glove.metrics first
+        request_context.set(None)
+        while True:
+            try:
+                self.write()
+            except OSError as e:
+                logger.warning('error writing metrics file, %s: %s', e.__class__.__name__, e)
+            await asyncio.sleep(self.write_interval)
+
+
+def render_histograms(name: str, help_: str, histograms: Iterable[Tuple[Tuple[str, str], Histogram]]) -> List[str]:
+    lines = [f'# HELP {name} {help_}', f'# TYPE {name} histogram']
+    for (method, template), h in histograms:
+        labels = route_labels(method, template)
+        if not h.count:
+            continue
+        cumulative = 0
+        for le, count in zip([*h.buckets, '+Inf'], h.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines += [f'{name}_sum{{{labels}}} {h.sum:0.6f}', f'{name}_count{{{labels}}} {cumulative}']
+    return lines
+
+
+def route_labels(method: str, template: str) -> str:
+    template = template.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'method="{method}",route="{template}"'
+
+
+class MetricsMiddleware:
+    """
+    Record per route histograms of queue time and handler time, status counts and requests in flight
+    in glove.metrics.
+
+    Routes are identified by their path template, e.g. "/users/{user_id}/", and non-standard methods are
+    recorded as "other", so metrics don't grow with the number of distinct paths or methods. If path is set,
+    metrics are served at that path (e.g. "/metrics") in the Prometheus text format, the path is not exposed
+    by default.
+    """
+
+    def __init__(self, app: ASGIApp, path: Optional[str] = None):
+        self.app = app
+        self.path = path
+
+        from .main import glove
+
+        self.glove = glove
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        metrics = self.glove.metrics
+        if scope['path'] == self.path:
+            response = Response(await metrics.render_async(), media_type=content_type)
+            await response(scope, receive, send)
+            return
+
+        start = perf_counter()
+        queue_time = None
+        if request_start := get_header(scope, b'x-request-start'):
+            try:
+                queue_time = max(time() - float(request_start) / 1000, 0)
+            except ValueError:
+                pass
+
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        metrics.in_flight += 1
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            metrics.in_flight -= 1
+            method = scope['method']
+            if method not in known_methods:
+                method = other_method
+            route_metrics = metrics.route(method, route_template(scope) or unmatched_route)
+            route_metrics.handler.observe(perf_counter() - start)
+            if queue_time is not None:
+                route_metrics.queue.observe(queue_time)
+            route_metrics.statuses[status] = route_metrics.statuses.get(status, 0) + 1
+            get_pg_conn = scope.get('state', {}).get('get_pg_conn')
+            if get_pg_conn is not None:
+                for conn in get_pg_conn.acquired():
+                    route_metrics.pg_wait.observe(conn.wait_time)
+                    route_metrics.pg_hold.observe(conn.hold_time)
@@ -3,10 +3,25 @@ import json
 import logging
 import re
 import secrets
-from ipaddress import ip_address, ip_network
-from operator import attrgetter
+from collections.abc import Mapping
 from time import time
-from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Literal, Optional, Set
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+from weakref import WeakSet
 
 from sentry_sdk import capture_event
 from sentry_sdk.utils import event_from_exception, exc_info_from_error
@@ -16,10 +31,14 @@ from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
 from starlette.responses import RedirectResponse, Response
 from starlette.routing import get_name as get_endpoint_name
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 from . import glove
-from .exceptions import UnexpectedResponse
-from .utils import get_ip
+from .cloudflare import IPRangeCounter, IPRangeTable, get_cloudflare_ips  # noqa: F401
+from .context import request_context
+from .db.middleware import GetPgConn, pg_conn_sender
+from .sessions import LazySession
+from .utils import get_header, get_ip, route_template, scope_request_start
 
 logger = logging.getLogger('foxglove.middleware')
 request_logger = logging.getLogger('foxglove.bad_requests')
@@ -27,60 +46,66 @@ CallNext = Callable[[Request], Awaitable[Response]]
 
 __all__ = (
     'ErrorMiddleware',
+    'AsgiErrorMiddleware',
     'CsrfMiddleware',
+    'AsgiCsrfMiddleware',
     'HostRedirectMiddleware',
+    'AsgiHostRedirectMiddleware',
+    'FoxgloveStack',
     'CloudflareCheckMiddleware',
+    'LoadSheddingMiddleware',
     'request_log_extra',
+    'RequestSnapshot',
     'get_session_id',
     'update_session_id',
 )
 
 
-class ErrorMiddleware(BaseHTTPMiddleware):
+class ErrorLogger:
+    """
+    Logging of failed requests shared by ErrorMiddleware and AsgiErrorMiddleware.
+    """
+
     def __init__(
         self,
-        app: Starlette,
         should_warn: Callable[[Response], bool] = None,
         get_user: Callable[[Request], Awaitable[Dict[str, Any]]] = None,
     ):
-        super().__init__(app)
         self.custom_should_warn = should_warn
         self.get_user = get_user
+        self._sampler: Optional[WarningSampler] = None
 
         from .main import glove
 
         self.glove = glove
 
-    async def dispatch(self, request: Request, call_next: CallNext) -> Response:
-        try:
-            request.state.start_time = get_request_start(request)
-
-            try:
-                response = await call_next(request)
-            except Exception as exc:
-                await self.log(request, exc=exc)
-                return Response('Internal Server Error', media_type='text/plain', status_code=500)
-            else:
-                if self.should_warn(response):
-                    await self.log(request, response=response)
-                return response
-        except Exception:  # pragma: no cover
-            # not sure if this is required, but better to keep it
-            logger.critical('unhandled error in ErrorMiddleware', exc_info=True)
-            raise
-
     async def log(
         self, request: Request, *, exc: Optional[Exception] = None, response: Optional[Response] = None
+    ) -> None:
+        """
+        Log a failed request, if settings.log_in_background is set, only a snapshot of the request and response
+        is taken here, the log record and sentry event are built and sent from glove.log_queue.
+        """
+        user = await self.user_info(request)
+        if self.glove.settings.log_in_background:
+            if response is not None:
+                response = await snapshot_response(response)
+            self.glove.log_queue.put(self.emit, snapshot_request(request), user, exc, response)
+        else:
+            await self.emit(request, user, exc, response)
+
+    async def emit(
+        self, request: Request, user: Dict[str, Any], exc: Optional[Exception], response: Optional[Response]
     ) -> None:
         event_data = await request_log_extra(request, exc, response)
-        event_data['user'] = await self.user_info(request)
+        event_data['user'] = user
         view_ref = event_data['transaction']
 
         if exc:
             level = 'error'
             message = f'"{line_one(request)}", {exc!r}'
             fingerprint = view_ref, request.method, repr(exc)
-            request_logger.exception(message, extra=event_data)
+            request_logger.error(message, exc_info=exc, extra=event_data)
         else:
             assert response is not None
             level = 'warning'
@@ -108,6 +133,19 @@ class ErrorMiddleware(BaseHTTPMiddleware):
         else:
             return response.status_code > 310
 
+    def sample_warning(self, scope: Scope, status_code: int) -> bool:
+        """
+        Whether a warning should be logged for this response or suppressed by sampling, this is called
+        before anything is captured for the log.
+        """
+        settings = self.glove.settings
+        if settings.log_warnings_per_second is None:
+            return True
+        if self._sampler is None:
+            self._sampler = WarningSampler(settings.log_warnings_per_second, settings.log_warnings_burst)
+        self._sampler.start()
+        return self._sampler.allow((get_transaction(scope), scope['method'], str(status_code)))
+
     async def user_info(self, request: Request) -> Dict[str, Any]:
         user = dict(ip_address=get_ip(request))
         if get_user := self.get_user:
@@ -119,17 +157,129 @@ class ErrorMiddleware(BaseHTTPMiddleware):
 
     @staticmethod
     async def response_body(response: Response) -> bytes:
-        if hasattr(response, 'body'):
-            return response.body
-        else:
-            body_chunks = []
-            async for chunk in response.body_iterator:
+        return await get_response_body(response)
+
+    async def log_streaming_response(
+        self, request: Request, response: Response, body_iterator: AsyncIterator[Union[str, bytes]]
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Stream the response body while capturing the start of it, then log the response once it's been sent.
+        """
+        capture = BodyCapture(self.glove.settings.log_max_body_size)
+        try:
+            async for chunk in body_iterator:
                 if not isinstance(chunk, bytes):
                     chunk = chunk.encode(response.charset)
-                body_chunks.append(chunk)
+                capture.add(chunk)
+                yield chunk
+        finally:
+            response.body = capture.body()
+            await self.log(request, response=response)
+
+
+class ErrorMiddleware(ErrorLogger, BaseHTTPMiddleware):
+    def __init__(
+        self,
+        app: Starlette,
+        should_warn: Callable[[Response], bool] = None,
+        get_user: Callable[[Request], Awaitable[Dict[str, Any]]] = None,
+    ):
+        BaseHTTPMiddleware.__init__(self, app)
+        ErrorLogger.__init__(self, should_warn, get_user)
 
-            response.body_iterator = async_gen_list(body_chunks)
-            return b''.join(body_chunks)
+    async def dispatch(self, request: Request, call_next: CallNext) -> Response:
+        try:
+            request.state.start_time = get_request_start(request)
+
+            try:
+                response = await call_next(request)
+            except Exception as exc:
+                await self.log(request, exc=exc)
+                return Response('Internal Server Error', media_type='text/plain', status_code=500)
+            else:
+                if self.should_warn(response) and self.sample_warning(request.scope, response.status_code):
+                    if hasattr(response, 'body'):
+                        await self.log(request, response=response)
+                    else:
+                        # log once the body has been streamed rather than buffering it before responding
+                        response.body_iterator = self.log_streaming_response(request, response, response.body_iterator)
+                return response
+        except Exception:  # pragma: no cover
+            # not sure if this is required, but better to keep it
+            logger.critical('unhandled error in ErrorMiddleware', exc_info=True)
+            raise
+
+
+class AsgiErrorMiddleware(ErrorLogger):
+    """
+    Pure ASGI equivalent of ErrorMiddleware, this avoids the extra task, memory streams and response
+    re-wrapping of BaseHTTPMiddleware by wrapping send directly.
+
+    The status is checked when the response starts, the body is only collected if a warning will be logged,
+    and then only up to settings.log_max_body_size bytes.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        should_warn: Callable[[Response], bool] = None,
+        get_user: Callable[[Request], Awaitable[Dict[str, Any]]] = None,
+    ):
+        super().__init__(should_warn, get_user)
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            scope.setdefault('state', {})['start_time'] = scope_request_start(scope)
+            response: Optional[Response] = None
+            capture: Optional[BodyCapture] = None
+
+            async def send_wrapper(message: Message) -> None:
+                nonlocal response, capture
+                if message['type'] == 'http.response.start':
+                    response = self.message_response(scope, message)
+                    if response is not None:
+                        capture = BodyCapture(self.glove.settings.log_max_body_size)
+                elif capture is not None and message['type'] == 'http.response.body':
+                    capture.add(message.get('body', b''))
+                await send(message)
+
+            try:
+                await self.call_app(scope, receive, send_wrapper)
+            except Exception as exc:
+                await self.log(Request(scope, receive), exc=exc)
+                if response is not None:
+                    # the response has already started, all we can do is let the server deal with the error
+                    raise
+                await Response('Internal Server Error', media_type='text/plain', status_code=500)(scope, receive, send)
+            else:
+                if capture is not None:
+                    response.body = capture.body()
+                    await self.log(Request(scope, receive), response=response)
+        except Exception:  # pragma: no cover
+            logger.critical('unhandled error in AsgiErrorMiddleware', exc_info=True)
+            raise
+
+    async def call_app(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await self.app(scope, receive, send)
+
+    def message_response(self, scope: Scope, message: Message) -> Optional[Response]:
+        """
+        Return a Response to log if "http.response.start" means a warning should be logged, else None.
+
+        A Response is only created when required, either because of a custom should_warn or to log.
+        """
+        status = message['status']
+        if self.custom_should_warn is None and status <= 310:
+            return None
+        response = Response(status_code=status)
+        response.raw_headers = list(message.get('headers', []))
+        if self.should_warn(response) and self.sample_warning(scope, status):
+            return response
 
 
 async def request_log_extra(
@@ -138,10 +288,15 @@ async def request_log_extra(
     extra = dict(query=dict(request.query_params))
 
     if start_time := getattr(request.state, 'start_time', None):
-        extra['duration'] = f'{(time() - start_time) * 1000:0.2f}ms'
+        end_time = getattr(request.state, 'end_time', None) or time()
+        extra['duration'] = f'{(end_time - start_time) * 1000:0.2f}ms'
 
     if endpoint := request.scope.get('endpoint'):
-        extra.update(route_endpoint=get_endpoint_name(endpoint), path_params=dict(request.path_params))
+        extra.update(route_endpoint=route_endpoint_name(request.scope, endpoint), path_params=dict(request.path_params))
+
+    get_pg_conn: Optional[GetPgConn] = getattr(request.state, 'get_pg_conn', None)
+    if get_pg_conn is not None and (db := get_pg_conn.log_extra()):
+        extra['db'] = db
 
     if exc:
         extra['exception_extra'] = exc_extra(exc)
@@ -149,42 +304,323 @@ async def request_log_extra(
         extra.update(
             response_status=response.status_code,
             response_headers=dict(response.headers),
-            response_body=lenient_json(await get_response_body(response)),
+            response_body=lenient_json(truncate_body(await get_response_body(response))),
         )
 
     return dict(
         extra=extra,
         user=dict(ip_address=get_ip(request)),
-        transaction=re.sub(r'/\d{2,}/', '/{number}/', str(request.url.path)),
-        request=dict(
-            url=str(request.url),
-            query_string=request.url.query,
-            cookies=dict(request.cookies),
-            headers=dict(request.headers),
-            method=request.method,
-            data=lenient_json(request.scope.get('_body')),
-            inferred_content_type=request.headers.get('Content-Type'),
-        ),
+        transaction=get_transaction(request.scope),
+        request=RequestSnapshot(request),
     )
 
 
+filtered = '[Filtered]'
+
+
+class RequestSnapshot(Mapping):
+    """
+    Request data for logs and sentry events, each field is only computed when it's first read, e.g. by a log
+    formatter or sentry's serializer.
+
+    The body is truncated to max_body_size (default settings.log_max_body_size) and, if scrub_cookies is set
+    (default settings.log_scrub_cookies), cookie values and the cookie header are replaced with "[Filtered]".
+    """
+
+    __slots__ = 'request', 'max_body_size', 'scrub_cookies', '_values'
+    fields = 'url', 'query_string', 'cookies', 'headers', 'method', 'data', 'inferred_content_type'
+
+    def __init__(self, request: Request, *, max_body_size: Optional[int] = None, scrub_cookies: Optional[bool] = None):
+        self.request = request
+        self.max_body_size = glove.settings.log_max_body_size if max_body_size is None else max_body_size
+        self.scrub_cookies = glove.settings.log_scrub_cookies if scrub_cookies is None else scrub_cookies
+        self._values: Dict[str, Any] = {}
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return self._values[key]
+        except KeyError:
+            if key not in self.fields:
+                raise
+        value = self._values[key] = getattr(self, f'_get_{key}')()
+        return value
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.fields)
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+    def __repr__(self):
+        return f'RequestSnapshot({dict(self)!r})'
+
+    def _get_url(self) -> str:
+        return str(self.request.url)
+
+    def _get_query_string(self) -> str:
+        return self.request.url.query
+
+    def _get_cookies(self) -> Dict[str, str]:
+        if self.scrub_cookies:
+            return {k: filtered for k in self.request.cookies}
+        else:
+            return dict(self.request.cookies)
+
+    def _get_headers(self) -> Dict[str, str]:
+        headers = dict(self.request.headers)
+        if self.scrub_cookies and 'cookie' in headers:
+            headers['cookie'] = filtered
+        return headers
+
+    def _get_method(self) -> str:
+        return self.request.method
+
+    def _get_data(self) -> Any:
+        body = self.request.scope.get('_body')
+        if body is not None:
+            return lenient_json(truncate_body(body, self.max_body_size))
+
+    def _get_inferred_content_type(self) -> Optional[str]:
+        return self.request.headers.get('content-type')
+
+
 async def get_response_body(response: Response) -> bytes:
+    """
+    Get the body of a response for logging, if the response is streaming only the first
+    settings.log_max_body_size bytes are read, the body iterator is replaced to yield those bytes followed
+    by the rest of the original iterator.
+    """
     if hasattr(response, 'body'):
         return response.body
     else:
+        capture = BodyCapture(glove.settings.log_max_body_size)
         body_chunks = []
-        async for chunk in response.body_iterator:
+        body_iterator = response.body_iterator
+        async for chunk in body_iterator:
             if not isinstance(chunk, bytes):
                 chunk = chunk.encode(response.charset)
             body_chunks.append(chunk)
+            capture.add(chunk)
+            if capture.truncated:
+                break
+
+        response.body_iterator = async_gen_list(body_chunks, body_iterator)
+        return capture.body()
+
+
+class BodyCapture:
+    """
+    Collect the start of a body up to max_size bytes while counting the total size.
+    """
+
+    __slots__ = 'max_size', 'chunks', 'size'
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.chunks: List[bytes] = []
+        self.size = 0
+
+    def add(self, chunk: bytes) -> None:
+        if self.size <= self.max_size:
+            # one byte more than max_size is kept so body() knows to add the truncation marker
+            self.chunks.append(chunk[: self.max_size + 1 - self.size])
+        self.size += len(chunk)
 
-        response.body_iterator = async_gen_list(body_chunks)
-        return b''.join(body_chunks)
+    @property
+    def truncated(self) -> bool:
+        return self.size > self.max_size
 
+    def body(self) -> bytes:
+        return truncate_body(b''.join(self.chunks), self.max_size)
+
+
+def truncate_body(body: bytes, max_size: Optional[int] = None) -> bytes:
+    """
+    Truncate a body to max_size, defaulting to settings.log_max_body_size, adding a marker if it was truncated.
+    """
+    if max_size is None:
+        max_size = glove.settings.log_max_body_size
+    if len(body) > max_size:
+        return body[:max_size] + b'...[truncated]'
+    else:
+        return body
 
-async def async_gen_list(list_: List[bytes]) -> AsyncGenerator[bytes, None]:
+
+def snapshot_request(request: Request) -> Request:
+    """
+    Copy of a request for logging after the response has been sent, the scope and its state are copied
+    so later changes don't affect the log, the end time is recorded so the logged duration is correct.
+    """
+    scope = dict(request.scope)
+    scope['headers'] = list(scope['headers'])
+    scope['state'] = dict(scope.get('state') or {}, end_time=time())
+    return Request(scope)
+
+
+async def snapshot_response(response: Response) -> Response:
+    """
+    Copy of the status, headers and body of a response for logging after the response has been sent.
+    """
+    snapshot = Response(status_code=response.status_code)
+    snapshot.raw_headers = list(response.raw_headers)
+    snapshot.body = await get_response_body(response)
+    return snapshot
+
+
+async def async_gen_list(
+    list_: List[bytes], rest: Optional[AsyncIterator[Union[str, bytes]]] = None
+) -> AsyncGenerator[Union[str, bytes], None]:
     for c in list_:
         yield c
+    if rest is not None:
+        async for c in rest:
+            yield c
+
+
+def get_transaction(scope: Scope) -> str:
+    """
+    Name used to group request errors, this is the path template of the matched route, e.g. "/users/{user_id}/",
+    or for unmatched requests the path with numeric IDs replaced.
+    """
+    root_path = scope.get('root_path', '')
+    if template := route_template(scope):
+        return root_path + template
+    else:
+        return number_path_segment.sub('/{number}/', root_path + scope['path'])
+
+
+number_path_segment = re.compile(r'/\d{2,}/')
+
+
+def route_endpoint_name(scope: Scope, endpoint: Any) -> str:
+    """
+    Name of the endpoint function of the matched route, cached on the route so it's only worked out once per route.
+    """
+    route = scope.get('route')
+    if route is None:
+        return get_endpoint_name(endpoint)
+    try:
+        return route.foxglove_endpoint_name
+    except AttributeError:
+        name = get_endpoint_name(endpoint)
+        try:
+            route.foxglove_endpoint_name = name
+        except AttributeError:
+            # e.g. routes with __slots__
+            pass
+        return name
+
+
+class WarningSampler:
+    """
+    Token bucket per fingerprint of request warnings, each fingerprint can log "burst" warnings at once, then
+    "rate" warnings per second. Once max_fingerprints are being tracked, new fingerprints share a bucket
+    per method and status so traffic to many different paths is also limited.
+
+    Suppressed warnings are counted and a summary is logged every summary_interval seconds by a background task
+    started with start(), or with the first warning checked after summary_interval if the task isn't running.
+    stop(), called for all samplers by glove.shutdown(), logs a final summary so suppressed counts are never lost.
+    """
+
+    def __init__(self, rate: float, burst: int, *, max_fingerprints: int = 1000, summary_interval: float = 60):
+        self.rate = rate
+        self.burst = burst
+        self.max_fingerprints = max_fingerprints
+        self.summary_interval = summary_interval
+        self.suppressed_total = 0
+        # fingerprint -> [tokens, last updated]
+        self._buckets: Dict[Tuple[str, ...], List[float]] = {}
+        self._suppressed: Dict[Tuple[str, ...], int] = {}
+        self._last_summary = time()
+        self._loop_task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """
+        Start logging summaries in the background, this requires a running event loop.
+        """
+        task = self._loop_task
+        # the task is restarted if the sampler outlives the event loop it was started in, e.g. in tests
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            self._loop_task = asyncio.create_task(self._summary_loop())
+            warning_samplers.add(self)
+
+    async def stop(self) -> None:
+        if (task := self._loop_task) is not None:
+            if task.get_loop() is asyncio.get_running_loop():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+            elif not task.get_loop().is_closed():
+                task.cancel()
+            self._loop_task = None
+            warning_samplers.discard(self)
+        self.summarise()
+
+    def allow(self, fingerprint: Tuple[str, ...]) -> bool:
+        now = time()
+        if now - self._last_summary >= self.summary_interval:
+            self.summarise(now)
+
+        bucket = self._buckets.get(fingerprint)
+        if bucket is None:
+            if len(self._buckets) >= self.max_fingerprints:
+                fingerprint = ('*',) + fingerprint[1:]
+                bucket = self._buckets.get(fingerprint)
+            if bucket is None:
+                bucket = self._buckets[fingerprint] = [self.burst, now]
+
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return True
+        else:
+            bucket[0] = tokens
+            self._suppressed[fingerprint] = self._suppressed.get(fingerprint, 0) + 1
+            self.suppressed_total += 1
+            return False
+
+    def summarise(self, now: Optional[float] = None) -> None:
+        """
+        Log a summary of suppressed warnings since the last summary, and forget buckets which have refilled.
+        """
+        now = now or time()
+        if self._suppressed:
+            suppressed = sorted(self._suppressed.items(), key=lambda x: x[1], reverse=True)
+            logger.warning(
+                '%d request warnings suppressed by sampling in the last %0.0fs',
+                sum(self._suppressed.values()),
+                now - self._last_summary,
+                extra={'suppressed': {' '.join(fingerprint): count for fingerprint, count in suppressed}},
+            )
+            self._suppressed = {}
+        self._last_summary = now
+        self._buckets = {
+            fingerprint: bucket
+            for fingerprint, bucket in self._buckets.items()
+            if bucket[0] + (now - bucket[1]) * self.rate < self.burst
+        }
+
+    async def _summary_loop(self) -> None:
+        # this task is started during a request, its logs shouldn't be attributed to that request
+        request_context.set(None)
+        while True:
+            await asyncio.sleep(max(self._last_summary + self.summary_interval - time(), 0))
+            if time() - self._last_summary >= self.summary_interval:
+                self.summarise()
+
+
+# samplers with a running summary task, stopped by glove.shutdown()
+warning_samplers: 'WeakSet[WarningSampler]' = WeakSet()
+
+
+async def stop_warning_samplers() -> None:
+    """
+    Stop the summary tasks of all warning samplers, logging their final summaries.
+    """
+    await asyncio.gather(*[sampler.stop() for sampler in list(warning_samplers)])
 
 
 def line_one(request: Request) -> str:
@@ -194,11 +630,8 @@ def line_one(request: Request) -> str:
     return line
 
 
-def get_request_start(request):
-    try:
-        return float(request.headers.get('X-Request-Start', '.')) / 1000
-    except ValueError:
-        return time()
+def get_request_start(request: Request) -> float:
+    return scope_request_start(request.scope)
 
 
 def exc_extra(exc: Exception):
@@ -243,47 +676,58 @@ def update_session_id(request: Request) -> str:
     return new_session_id
 
 
-class CsrfMiddleware(BaseHTTPMiddleware):
-    """
-    Ensures a GET request has been made before post requests and that session_id is set in the session.
+benign_methods = {'HEAD', 'GET', 'OPTIONS'}
 
-    This prevents CSRF especially if the cookie has same_site strict
+
+class CsrfChecker:
+    """
+    CSRF checks shared by CsrfMiddleware and FoxgloveStack.
     """
 
     def __init__(
         self,
-        app: Starlette,
         *,
         should_check: Callable[[Request], bool] = None,
         enable_header_check: bool = None,
         allows_origins: Set[str] = None,
     ):
-        super().__init__(app)
         self.should_check = should_check
         if enable_header_check is None:
             self.enable_header_check = not (glove.settings.dev_mode or glove.settings.test_mode)
         else:
             self.enable_header_check = enable_header_check
-        self.allows_origins = glove.settings.origin if allows_origins is None else allows_origins
-
-    async def dispatch(self, request: Request, call_next: CallNext) -> Response:
-        if self.should_check and not self.should_check(request):
-            return await call_next(request)
-
-        session_id = request.session.get(session_id_key)
-        benign_request = request.method in {'HEAD', 'GET', 'OPTIONS'}
-        if not benign_request:
-            if session_id is None:
-                return Response(no_cookie_response, media_type='application/json', status_code=403)
-            if error := self.header_check(request):
-                return Response(header_error_response % error, media_type='application/json', status_code=403)
-
-        response = await call_next(request)
+        origins = glove.settings.origin if allows_origins is None else allows_origins
+        if origins is None:
+            origins = ()
+        elif isinstance(origins, str):
+            origins = (origins,)
+        # exact origins, a str setting is a single origin not a string to search in
+        self.allows_origins: FrozenSet[str] = frozenset(origins)
+        self.allows_origins_bytes: FrozenSet[bytes] = frozenset(o.encode() for o in origins)
+
+    def check_required(self, request: Request) -> bool:
+        return not self.should_check or self.should_check(request)
+
+    def scope_check_required(self, scope: Scope, receive: Receive) -> bool:
+        return not self.should_check or self.should_check(Request(scope, receive))
+
+    def request_error(self, request: Request, session_id: Optional[str]) -> Optional[Response]:
+        """
+        Check a request which isn't benign, returning an error response if it's not permitted.
+        """
+        if session_id is None:
+            return Response(no_cookie_response, media_type='application/json', status_code=403)
+        if error := self.header_check(request):
+            return Response(header_error_response % error, media_type='application/json', status_code=403)
 
-        # set the session id for any valid GET request
-        if benign_request and response.status_code == 200 and session_id is None:
-            update_session_id(request)
-        return response
+    def scope_error(self, scope: Scope, session_id: Optional[str]) -> Optional[Response]:
+        """
+        Equivalent of request_error using raw headers from the scope.
+        """
+        if session_id is None:
+            return Response(no_cookie_response, media_type='application/json', status_code=403)
+        if error := self.scope_header_check(scope):
+            return Response(header_error_response % error, media_type='application/json', status_code=403)
 
     def header_check(self, request: Request) -> Optional[str]:
         """
@@ -308,6 +752,139 @@ class CsrfMiddleware(BaseHTTPMiddleware):
         elif not origin_ok:
             return 'Missing Origin and Referrer headers'
 
+    def scope_header_check(self, scope: Scope) -> Optional[str]:
+        """
+        Equivalent of header_check comparing raw header bytes with allows_origins_bytes.
+        """
+        if not self.enable_header_check:
+            return
+
+        origin_ok = False
+        if origin := get_header(scope, b'origin'):
+            if origin not in self.allows_origins_bytes:
+                return 'Incorrect Origin header'
+            origin_ok = True
+
+        if referrer := get_header(scope, b'referer'):
+            if referrer_origin(referrer) not in self.allows_origins_bytes:
+                return 'Incorrect Referrer header'
+        elif not origin_ok:
+            return 'Missing Origin and Referrer headers'
+
+
+url_netloc_end = re.compile(rb'[/?#]')
+
+
+def referrer_origin(referrer: bytes) -> bytes:
+    """
+    "<scheme>://<hostname>" from a referrer URL, without the port or user info, as used by CsrfChecker.header_check.
+    """
+    scheme, _, rest = referrer.partition(b'://')
+    netloc = url_netloc_end.split(rest, 1)[0]
+    return scheme.lower() + b'://' + netloc_hostname(netloc)
+
+
+def netloc_hostname(netloc: bytes) -> bytes:
+    """
+    Hostname from a URL netloc or host header, without user info or port, equivalent to URL.hostname.
+    """
+    host = netloc.rpartition(b'@')[2]
+    if host.startswith(b'['):
+        host = host[1 : host.find(b']')]
+    else:
+        host = host.partition(b':')[0]
+    return host.lower()
+
+
+class CsrfMiddleware(CsrfChecker, BaseHTTPMiddleware):
+    """
+    Ensures a GET request has been made before post requests and that session_id is set in the session.
+
+    This prevents CSRF especially if the cookie has same_site strict
+    """
+
+    def __init__(
+        self,
+        app: Starlette,
+        *,
+        should_check: Callable[[Request], bool] = None,
+        enable_header_check: bool = None,
+        allows_origins: Set[str] = None,
+    ):
+        BaseHTTPMiddleware.__init__(self, app)
+        CsrfChecker.__init__(
+            self, should_check=should_check, enable_header_check=enable_header_check, allows_origins=allows_origins
+        )
+
+    async def dispatch(self, request: Request, call_next: CallNext) -> Response:
+        if not self.check_required(request):
+            return await call_next(request)
+
+        session_id = request.session.get(session_id_key)
+        benign_request = request.method in benign_methods
+        if not benign_request:
+            if error_response := self.request_error(request, session_id):
+                return error_response
+
+        response = await call_next(request)
+
+        # set the session id for any valid GET request
+        if benign_request and response.status_code == 200 and session_id is None:
+            update_session_id(request)
+        return response
+
+
+class AsgiCsrfMiddleware(CsrfChecker):
+    """
+    Pure ASGI equivalent of CsrfMiddleware, Origin and Referer headers are compared as raw bytes to
+    a precomputed set of allowed origins and benign requests don't read the session until the response starts.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        *,
+        should_check: Callable[[Request], bool] = None,
+        enable_header_check: bool = None,
+        allows_origins: Set[str] = None,
+    ):
+        super().__init__(
+            should_check=should_check, enable_header_check=enable_header_check, allows_origins=allows_origins
+        )
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or not self.scope_check_required(scope, receive):
+            await self.app(scope, receive, send)
+            return
+
+        if scope['method'] in benign_methods:
+            await self.app(scope, receive, session_id_sender(scope, send))
+        elif error_response := self.scope_error(scope, scope['session'].get(session_id_key)):
+            await error_response(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+def session_id_sender(scope: Scope, send: Send) -> Send:
+    """
+    Wrap send to set the session id for successful benign requests if it's not already set,
+    this must happen before the session is saved by SessionMiddleware.
+
+    With foxglove's SessionMiddleware the session is only loaded (and so possibly re-signed) if the session id needs
+    to be set.
+    """
+
+    async def send_wrapper(message: Message) -> None:
+        if message['type'] == 'http.response.start' and message['status'] == 200:
+            session = scope['session']
+            has_id = session.peek(session_id_key) if isinstance(session, LazySession) else session_id_key in session
+            if not has_id:
+                session[session_id_key] = secrets.token_urlsafe()
+        await send(message)
+
+    return send_wrapper
+
 
 class HostRedirectMiddleware(BaseHTTPMiddleware):
     def __init__(self, app: Starlette, host: str = None):
@@ -322,79 +899,239 @@ class HostRedirectMiddleware(BaseHTTPMiddleware):
             return RedirectResponse(request.url.replace(hostname=self.host), status_code=301)
 
 
-class IPRangeCounter:
-    __slots__ = 'range', 'counter'
+class AsgiHostRedirectMiddleware:
+    """
+    Pure ASGI equivalent of HostRedirectMiddleware, the host header is compared with the expected host as bytes,
+    the redirect URL is only built if they don't match.
+    """
 
-    def __init__(self, network_range: str):
-        self.range = ip_network(network_range)
-        self.counter = 0
+    def __init__(self, app: ASGIApp, host: str = None):
+        self.app = app
+        self.host = host or glove.settings.domain
+        assert self.host, 'host must not be None in AsgiHostRedirectMiddleware'
+        self.host_bytes = self.host.lower().encode()
 
-    def __repr__(self):
-        return f'IPRangeCounter({self.range}, {self.counter})'
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or scope_host_matches(scope, self.host_bytes):
+            await self.app(scope, receive, send)
+        else:
+            url = Request(scope, receive).url
+            await RedirectResponse(url.replace(hostname=self.host), status_code=301)(scope, receive, send)
+
+
+def scope_host_matches(scope: Scope, host: bytes) -> bool:
+    """
+    Whether the hostname of a request, without the port, is host.
+    """
+    if host_header := get_header(scope, b'host'):
+        return netloc_hostname(host_header) == host
+    else:
+        # no host header, fall back to the server address like starlette's URL
+        return Request(scope).url.hostname == host.decode()
+
+
+class FoxgloveStack(AsgiErrorMiddleware):
+    """
+    ErrorMiddleware, HostRedirectMiddleware, CsrfMiddleware and PgMiddleware fused into one ASGI callable,
+    the checks are run in that order before calling the app.
+
+    Since CSRF checks read the session, SessionMiddleware must be added outside (before) this middleware.
 
+    Arguments are the same as for the individual middleware except:
+    * host: if omitted, no host redirect is performed
+    * csrf: set to False to disable CSRF checks, should_check_csrf is CsrfMiddleware's should_check
+    * pg: set to False to not setup a lazy connection for get_db, like AsgiPgMiddleware the connection is
+      released when the response starts
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        *,
+        should_warn: Callable[[Response], bool] = None,
+        get_user: Callable[[Request], Awaitable[Dict[str, Any]]] = None,
+        host: str = None,
+        csrf: bool = True,
+        should_check_csrf: Callable[[Request], bool] = None,
+        enable_header_check: bool = None,
+        allows_origins: Set[str] = None,
+        pg: bool = True,
+    ):
+        super().__init__(app, should_warn=should_warn, get_user=get_user)
+        self.host = host
+        self.host_bytes = host.lower().encode() if host else None
+        if csrf:
+            self.csrf: Optional[CsrfChecker] = CsrfChecker(
+                should_check=should_check_csrf, enable_header_check=enable_header_check, allows_origins=allows_origins
+            )
+        else:
+            self.csrf = None
+        self.pg = pg
+
+    async def call_app(self, scope: Scope, receive: Receive, send: Send) -> None:
+        request = Request(scope, receive)
+        if self.host and not scope_host_matches(scope, self.host_bytes):
+            response = RedirectResponse(request.url.replace(hostname=self.host), status_code=301)
+            await response(scope, receive, send)
+            return
+
+        if self.csrf and self.csrf.check_required(request):
+            if scope['method'] in benign_methods:
+                send = session_id_sender(scope, send)
+            elif error_response := self.csrf.scope_error(scope, request.session.get(session_id_key)):
+                await error_response(scope, receive, send)
+                return
+
+        if self.pg:
+            request.state.get_pg_conn = get_pg_conn = GetPgConn(self.glove)
+            try:
+                await self.app(scope, receive, pg_conn_sender(get_pg_conn, send))
+            finally:
+                await get_pg_conn.release()
+        else:
+            await self.app(scope, receive, send)
+
+
+class CloudflareCheckMiddleware:
+    """
+    Check requests come from CloudFlare, IP ranges are from glove.cloudflare_ips, set settings.cloudflare_check
+    to load them in glove.startup(), otherwise they're loaded on the first request.
+
+    On Heroku (and any properly configured system) we can trust the last entry in X-Forwarded-For,
+    hence using that before trying client, see https://stackoverflow.com/a/37061471/949890.
+
+    The IP is taken straight from the raw headers and checked against glove.cloudflare_ips which caches verdicts,
+    so accepted requests never need a Request object.
+    """
 
-class CloudflareCheckMiddleware(BaseHTTPMiddleware):
     default_response_body = b'Request incorrectly routed, this looks like a problem with your DNS or Proxy.'
 
-    def __init__(self, app: Starlette, response_text: str = None):
-        super().__init__(app)
+    def __init__(self, app: ASGIApp, response_text: str = None):
+        self.app = app
         self.response_body = response_text.encode() if response_text else self.default_response_body
-        self.ip_ranges: Optional[List[IPRangeCounter]] = None
 
-    async def dispatch(self, request: Request, call_next: CallNext) -> Response:
-        """
-        On Heroku (and any properly configured system) we can trust the last entry in X-Forwarded-For,
-        hence using that before trying client
+    @property
+    def ip_ranges(self) -> IPRangeTable:
+        return glove.cloudflare_ips.table
 
-        https://stackoverflow.com/a/37061471/949890
-        """
-        ip = None
-        x_forwarded_for = request.headers.get('x-forwarded-for')
-        if x_forwarded_for:
-            ip = x_forwarded_for.rsplit(',', 1)[-1].strip()
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        ip = self.client_ip(scope)
+        if ip and glove.cloudflare_ips.check(ip):
+            await self.app(scope, receive, send)
         else:
-            client = request.scope.get('client')
-            if client:
-                ip = client[0]
+            response = await self.reject(Request(scope, receive), ip)
+            await response(scope, receive, send)
 
-        if ip and await self.is_cloudflare_ip(ip):
+    async def dispatch(self, request: Request, call_next: CallNext) -> Response:
+        """
+        Equivalent of __call__ for use where BaseHTTPMiddleware style dispatch is required.
+        """
+        ip = self.client_ip(request.scope)
+        if ip and glove.cloudflare_ips.check(ip):
             return await call_next(request)
+        else:
+            return await self.reject(request, ip)
 
-        extra = {'extra': await request_log_extra(request), 'cf_ip_ranges': self.ip_ranges}
+    @staticmethod
+    def client_ip(scope: Scope) -> Union[str, bytes, None]:
+        x_forwarded_for = get_header(scope, b'x-forwarded-for')
+        if x_forwarded_for:
+            return x_forwarded_for.rpartition(b',')[2].strip()
+        client = scope.get('client')
+        if client:
+            return client[0]
+
+    async def reject(self, request: Request, ip: Union[str, bytes, None]) -> Response:
+        if isinstance(ip, bytes):
+            ip = ip.decode(errors='replace')
+        extra = {
+            'extra': await request_log_extra(request),
+            'cf_ip_ranges': self.ip_ranges,
+            'cf_verdicts': glove.cloudflare_ips.verdicts,
+        }
         logger.warning('Request not routed through CloudFlare ip=%s url="%s"', ip, request.url, extra=extra)
         return Response(self.response_body, status_code=400)
 
-    async def is_cloudflare_ip(self, ip: str) -> bool:
-        try:
-            ip = ip_address(ip.strip())
-        except ValueError:
-            pass
-        else:
-            if self.ip_ranges is None:
-                self.ip_ranges = ip_ranges = await get_cloudflare_ips()
-            else:
-                ip_ranges = self.ip_ranges
-
-            for r in ip_ranges:
-                if ip in r.range:
-                    r.counter += 1
-                    self.ip_ranges.sort(key=attrgetter('counter'), reverse=True)
-                    return True
-        return False
+    async def is_cloudflare_ip(self, ip: Union[str, bytes]) -> bool:
+        return glove.cloudflare_ips.check(ip.strip())
 
 
-async def get_cloudflare_ips() -> List[IPRangeCounter]:
+class LoadSheddingMiddleware:
     """
-    Get a list of cloudflare IPs from https://www.cloudflare.com/ips-v4 and https://www.cloudflare.com/ips-v6,
-    see https://www.cloudflare.com/en-gb/ips/ for details.
+    Reject requests with a fast 503 when this worker is falling behind, rather than spending time and database
+    connections on requests the client has probably given up on.
+
+    Requests are rejected if they've waited more than max_queue_time seconds between the router receiving them
+    and the app (from Heroku's "X-Request-Start" header), or if this worker is already handling max_in_flight
+    requests. Paths in exempt_paths, e.g. health and readiness checks, are never rejected.
     """
 
-    async def get_ips(v: Literal[4, 6]) -> List[IPRangeCounter]:
-        r = await glove.http.get(f'https://www.cloudflare.com/ips-v{v}', follow_redirects=True)
-        UnexpectedResponse.check(r)
-        return [IPRangeCounter(ip) for ip in r.text.strip().split('\n')]
+    response_body = b'Service Unavailable, please try again shortly.'
+    warning_interval = 60
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        *,
+        max_queue_time: Optional[float] = None,
+        max_in_flight: Optional[int] = None,
+        retry_after: int = 5,
+        exempt_paths: Iterable[str] = (),
+    ):
+        self.app = app
+        self.max_queue_time = max_queue_time
+        self.max_in_flight = max_in_flight
+        self.retry_after = str(retry_after)
+        self.exempt_paths = frozenset(exempt_paths)
+        self.in_flight = 0
+        self.shed = 0
+        self._shed_since_warning = 0
+        self._last_warning = 0.0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or scope['path'] in self.exempt_paths:
+            await self.app(scope, receive, send)
+            return
+
+        reason = self.shed_reason(scope)
+        if reason:
+            self.record_shed(reason)
+            response = Response(
+                self.response_body,
+                status_code=503,
+                media_type='text/plain',
+                headers={'Retry-After': self.retry_after},
+            )
+            await response(scope, receive, send)
+            return
 
-    v4_ips, v6_ips = await asyncio.gather(get_ips(4), get_ips(6))
-    ips = v4_ips + v6_ips
-    logger.info('downloaded %d IPs from CloudFlare to check requests against', len(ips))
-    return ips
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+
+    def shed_reason(self, scope: Scope) -> Optional[str]:
+        if self.max_in_flight is not None and self.in_flight >= self.max_in_flight:
+            return 'in flight'
+        if self.max_queue_time is not None and time() - scope_request_start(scope) > self.max_queue_time:
+            return 'queue time'
+
+    def record_shed(self, reason: str) -> None:
+        self.shed += 1
+        self._shed_since_warning += 1
+        now = time()
+        if now - self._last_warning > self.warning_interval:
+            logger.warning(
+                'load shedding, %d requests rejected (%d total), latest due to %s',
+                self._shed_since_warning,
+                self.shed,
+                reason,
+                extra={'in_flight': self.in_flight},
+            )
+            self._last_warning = now
+            self._shed_since_warning = 0
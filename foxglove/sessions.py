@@ -0,0 +1,186 @@
+import json
+import logging
+from base64 import b64decode, b64encode
+from time import time
+from typing import Any, Dict, Iterator, MutableMapping, Optional
+
+import itsdangerous
+from itsdangerous.exc import BadSignature
+from starlette.datastructures import MutableHeaders
+from starlette.requests import cookie_parser
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .main import glove
+from .utils import get_header
+
+logger = logging.getLogger('foxglove.sessions')
+
+__all__ = 'SessionMiddleware', 'LazySession'
+
+
+class LazySession(MutableMapping[str, Any]):
+    """
+    Session stored in a signed cookie which is only verified and decoded when the session is first accessed.
+    """
+
+    __slots__ = 'middleware', 'scope', 'loaded', 'cookie_present', 'original', 'timestamp', '_data'
+
+    def __init__(self, middleware: 'SessionMiddleware', scope: Scope):
+        self.middleware = middleware
+        self.scope = scope
+        self.loaded = False
+        # whether the request included a valid session cookie
+        self.cookie_present = False
+        # JSON of the session as received, used to decide if the cookie needs to be updated
+        self.original: Optional[str] = None
+        # when the cookie was signed
+        self.timestamp: Optional[float] = None
+        self._data: Dict[str, Any] = {}
+
+    @property
+    def data(self) -> Dict[str, Any]:
+        if not self.loaded:
+            self._load()
+        return self._data
+
+    def _cookie_value(self) -> Optional[str]:
+        if cookie_header := get_header(self.scope, b'cookie'):
+            return cookie_parser(cookie_header.decode('latin-1')).get(self.middleware.session_cookie)
+
+    def _load(self) -> None:
+        self.loaded = True
+        value = self._cookie_value()
+        if not value:
+            return
+        try:
+            payload, timestamp = self.middleware.signer.unsign(
+                value.encode(), max_age=self.middleware.max_age, return_timestamp=True
+            )
+            original = b64decode(payload).decode()
+            self._data = json.loads(original)
+        except (BadSignature, ValueError):
+            return
+        else:
+            self.original = original
+            self.timestamp = timestamp.timestamp()
+            self.cookie_present = True
+
+    def peek(self, key: str) -> bool:
+        """
+        Check if key is in the session without loading it, the cookie's signature and age are still verified so
+        a cookie which _load() would reject (e.g. signed with an old secret key) never counts as containing key.
+        """
+        if self.loaded:
+            return key in self._data
+        value = self._cookie_value()
+        if not value:
+            return False
+        try:
+            payload = self.middleware.signer.unsign(value.encode(), max_age=self.middleware.max_age)
+            data = json.loads(b64decode(payload))
+        except (BadSignature, ValueError):
+            return False
+        return isinstance(data, dict) and key in data
+
+    def __getitem__(self, key: str) -> Any:
+        return self.data[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.data[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        del self.data[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.data)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __repr__(self):
+        return f'LazySession({self.data!r})'
+
+
+class SessionMiddleware:
+    """
+    Drop in replacement for starlette's SessionMiddleware using the same cookie format, except:
+
+    * the cookie is only verified and decoded when request.session is first accessed
+    * the cookie is only signed and set when the session has changed, or when the signature is older than
+      refresh_after seconds so the max_age expiry is still extended for active sessions
+    * if the signed cookie would be larger than max_cookie_size bytes, it's not set and a warning is logged,
+      browsers silently ignore cookies over 4KB
+
+    secret_key and session_cookie default to settings.secret_key and settings.cookie_name.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        secret_key: Optional[str] = None,
+        session_cookie: Optional[str] = None,
+        max_age: Optional[int] = 14 * 24 * 60 * 60,
+        path: str = '/',
+        same_site: str = 'lax',
+        https_only: bool = False,
+        refresh_after: Optional[int] = 24 * 60 * 60,
+        max_cookie_size: int = 4096,
+    ):
+        self.app = app
+        self.signer = itsdangerous.TimestampSigner(str(secret_key or glove.settings.secret_key))
+        self.session_cookie = session_cookie or glove.settings.cookie_name
+        self.max_age = max_age
+        self.path = path
+        self.refresh_after = refresh_after
+        self.max_cookie_size = max_cookie_size
+        self.security_flags = f'httponly; samesite={same_site}'
+        if https_only:
+            self.security_flags += '; secure'
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] not in ('http', 'websocket'):
+            await self.app(scope, receive, send)
+            return
+
+        scope['session'] = session = LazySession(self, scope)
+
+        async def send_wrapper(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                if header_value := self.cookie_header(session):
+                    MutableHeaders(scope=message).append('Set-Cookie', header_value)
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    def cookie_header(self, session: LazySession) -> Optional[str]:
+        """
+        Set-Cookie header value if the cookie needs to be updated, else None.
+        """
+        if not session.loaded:
+            return None
+
+        if session:
+            data = json.dumps(session.data)
+            if data == session.original and not self.needs_refresh(session):
+                return None
+
+            value = self.signer.sign(b64encode(data.encode())).decode()
+            # browsers limit the size of the name and value together
+            cookie_size = len(self.session_cookie) + 1 + len(value)
+            if cookie_size > self.max_cookie_size:
+                logger.warning(
+                    'session cookie too large, %d bytes, max %d bytes, not updating cookie',
+                    cookie_size,
+                    self.max_cookie_size,
+                    extra={'session_keys': list(session)},
+                )
+                return None
+            max_age = f'Max-Age={self.max_age}; ' if self.max_age else ''
+            return f'{self.session_cookie}={value}; path={self.path}; {max_age}{self.security_flags}'
+        elif session.cookie_present:
+            # the session has been cleared
+            expires = 'expires=Thu, 01 Jan 1970 00:00:00 GMT; '
+            return f'{self.session_cookie}=null; path={self.path}; {expires}{self.security_flags}'
+
+    def needs_refresh(self, session: LazySession) -> bool:
+        return self.refresh_after is not None and time() - session.timestamp > self.refresh_after
@@ -49,6 +49,17 @@ class BaseSettings(PydanticBaseSettings):
     environment: str = Field(default='dev', validation_alias=AliasChoices('env', 'environment'))
     sentry_dsn: Optional[str] = None
     log_level: str = 'INFO'
+    # format and send request error logs in a background task, see foxglove.logs.LogQueue
+    log_in_background: bool = False
+    log_queue_size: int = 1000
+    # maximum size of request and response bodies included in request error logs
+    log_max_body_size: int = 10_000
+    # replace cookie values in request error logs with "[Filtered]"
+    log_scrub_cookies: bool = True
+    # sample request warnings (unexpected responses) by (transaction, method, status): log_warnings_burst warnings
+    # can be logged at once, then log_warnings_per_second, None to log all warnings
+    log_warnings_per_second: Optional[float] = None
+    log_warnings_burst: int = 10
     origin: Optional[str] = None
 
     bcrypt_rounds: int = 14
@@ -71,6 +82,22 @@ class BaseSettings(PydanticBaseSettings):
     pg_pool_max_size: int = 10
     pg_server_settings: Optional[Dict[str, str]] = {'jit': 'off'}
     pg_migrations: bool = False
+    # log a warning when a request waits longer than this many seconds to acquire a connection, None to disable
+    pg_acquire_warning_time: Optional[float] = 0.5
+    # requests which can't get a connection within this many seconds, or when pg_max_waiters requests are already
+    # waiting, get a 503 response with a Retry-After header of pg_retry_after seconds, None (the default) for no limit
+    pg_acquire_timeout: Optional[float] = None
+    pg_max_waiters: Optional[int] = None
+    pg_retry_after: int = 1
+    # optional read replica used by get_db_read, reads use the primary while it's down or its replication lag is
+    # more than pg_read_max_lag seconds (None to ignore lag), checked every pg_read_check_interval seconds
+    pg_read_dsn: Optional[str] = None
+    pg_read_max_lag: Optional[float] = 10
+    pg_read_check_interval: float = 5
+    # databases by shard name, requests are routed to them by key with get_db_for using a consistent hash ring with
+    # pg_shard_virtual_nodes points per shard, renaming shards moves keys between them
+    pg_shards: Dict[str, str] = {}
+    pg_shard_virtual_nodes: int = 100
 
     redis_settings: Optional[RedisSettings] = Field(
         default=redis_settings_default, validation_alias=AliasChoices('redis_settings', 'rediscloud_url', 'redis_url')
@@ -90,6 +117,24 @@ class BaseSettings(PydanticBaseSettings):
     csrf_cross_origin_paths: List[Pattern] = []
     cross_origin_origins: List[Pattern] = []
 
+    # CloudflareCheckMiddleware: set cloudflare_check to load IP ranges on startup, they're loaded from the cache
+    # file if it exists, otherwise from a snapshot bundled with foxglove, then refreshed in the background
+    cloudflare_check: bool = False
+    cloudflare_url: str = 'https://www.cloudflare.com'
+    cloudflare_ips_cache_path: Optional[Path] = None
+    # set to None to disable background refreshing of IP ranges
+    cloudflare_ips_refresh_interval: Optional[int] = 24 * 3600
+    # downloads with fewer ranges than this, or without both IPv4 and IPv6 ranges, are rejected and the current
+    # ranges are kept, CloudFlare currently has 22 ranges
+    cloudflare_ips_min_ranges: int = 10
+    # number of IPs to cache the result of checks for
+    cloudflare_verdict_cache_size: int = 4096
+
+    # MetricsMiddleware: set metrics_dir so each worker writes its metrics there and /metrics is aggregated
+    # across all workers, see foxglove.metrics
+    metrics_dir: Optional[Path] = None
+    metrics_write_interval: int = 10
+
     recaptcha_url: str = 'https://www.google.com/recaptcha/api/siteverify'
     # this is the recaptcha test key, you'll need to change it for production, see
     # https://developers.google.com/recaptcha/docs/faq#id-like-to-run-automated-tests-with-recaptcha-what-should-i-do
@@ -8,6 +8,7 @@ from typing import Any, Optional, Tuple, Union
 from starlette.responses import Response
 from starlette.templating import Jinja2Templates as _Jinja2Templates, _TemplateResponse
 
+from .etag import etag as mark_etag
 from .main import glove
 
 try:
@@ -29,7 +30,12 @@ class FoxgloveTemplates(_Jinja2Templates):
         super().__init__(directory, **env_options)
         self.env.globals.update(static_url=static_url, dev_mode=glove.settings.dev_mode)
 
-    def render(self, template_name: str):
+    def render(self, template_name: str, etag: bool = False):
+        """
+        Decorate a view to render template_name with the context it returns, if etag is True the view is marked for
+        ETagMiddleware so unchanged pages get a 304 response.
+        """
+
         def view_decorator(view):
             if asyncio.iscoroutinefunction(view):
 
@@ -43,6 +49,8 @@ class FoxgloveTemplates(_Jinja2Templates):
                 def view_wrapper(request, *args, **kwargs):
                     return self._return_template(request, template_name, view(request, *args, **kwargs))
 
+            if etag:
+                mark_etag(view_wrapper)
             return view_wrapper
 
         return view_decorator
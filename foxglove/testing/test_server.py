@@ -35,6 +35,16 @@ async def recaptcha_dummy(request):
         return json_response(dict(success=False, hostname='testserver'))
 
 
+dummy_cloudflare_ips = {
+    '4': '173.245.48.0/20\n103.21.244.0/22\n',
+    '6': '2400:cb00::/32\n',
+}
+
+
+async def cloudflare_ips_dummy(request):
+    return Response(text=dummy_cloudflare_ips[request.match_info['version']])
+
+
 @middleware
 async def log_middleware(request, handler):
     try:
@@ -57,6 +67,7 @@ def create_dummy_app() -> Application:
         [
             web.route('*', r'/status/{status:\d+}/', return_any_status, name='any-status'),
             web.post('/recaptcha_url/', recaptcha_dummy, name='recaptcha-dummy'),
+            web.get(r'/ips-v{version:[46]}', cloudflare_ips_dummy, name='cloudflare-ips-dummy'),
         ]
     )
     app['log'] = []
@@ -1,8 +1,10 @@
+from time import time
 from typing import Dict, List, Optional, TypeVar
 
 from starlette.requests import Request
+from starlette.types import Scope
 
-__all__ = 'get_ip', 'list_not_none', 'dict_not_none'
+__all__ = 'get_ip', 'get_header', 'scope_request_start', 'route_template', 'list_not_none', 'dict_not_none'
 
 IP_HEADER = 'X-Forwarded-For'
 
@@ -15,6 +17,35 @@ def get_ip(request: Request) -> Optional[str]:
         return client[0]
 
 
+def get_header(scope: Scope, name: bytes) -> Optional[bytes]:
+    """
+    Find a header in a raw ASGI scope without building a Request, name must be lowercase.
+    """
+    for key, value in scope['headers']:
+        if key == name:
+            return value
+
+
+def scope_request_start(scope: Scope, now: Optional[float] = None) -> float:
+    """
+    Time the request was received by the router, from Heroku's "X-Request-Start" header, or now.
+    """
+    try:
+        return float(get_header(scope, b'x-request-start') or b'.') / 1000
+    except ValueError:
+        return time() if now is None else now
+
+
+def route_template(scope: Scope) -> Optional[str]:
+    """
+    Path template of the route which matched a request, e.g. "/users/{user_id}/", this is only available once
+    the router has matched the request, None if no route matched or the route doesn't record itself on the scope.
+    """
+    route = scope.get('route')
+    if route is not None:
+        return getattr(route, 'path_format', None)
+
+
 T = TypeVar('T')
 
 
@@ -17,7 +17,7 @@ commit_transactions = 'KEEP_DB' in os.environ
 
 @pytest.fixture(scope='session', name='settings')
 def fix_settings():
-    settings = Settings(dev_mode=False, test_mode=True, bcrypt_rounds=4)
+    settings = Settings(dev_mode=False, test_mode=True, bcrypt_rounds=4, cloudflare_ips_refresh_interval=None)
     assert not settings.dev_mode
     glove._settings = settings
 
@@ -4,10 +4,10 @@ from typing import Optional
 
 from buildpg.asyncpg import BuildPgConnection
 from fastapi import Depends, FastAPI, Request
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from starlette.middleware import Middleware
-from starlette.middleware.sessions import SessionMiddleware
 
 from foxglove import BaseSettings, exceptions, glove
 from foxglove.auth import rate_limit
@@ -16,6 +16,7 @@ from foxglove.db.middleware import get_db
 from foxglove.middleware import CsrfMiddleware, ErrorMiddleware
 from foxglove.recaptcha import RecaptchaDepends
 from foxglove.route_class import SafeAPIRoute
+from foxglove.sessions import SessionMiddleware
 from foxglove.templates import FoxgloveTemplates
 
 logger = logging.getLogger('main')
@@ -90,6 +91,15 @@ async def error(error: str = 'raise'):
         return {'error': error}
 
 
+@app.get('/stream-error/')
+async def stream_error(size: int = 1000):
+    async def stream():
+        for _ in range(size // 100):
+            yield b'x' * 100
+
+    return StreamingResponse(stream(), status_code=500)
+
+
 def worker(settings: BaseSettings):
     asyncio.run(aworker(settings))
 
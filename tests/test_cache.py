@@ -0,0 +1,222 @@
+import asyncio
+from time import time
+
+import pytest
+from fastapi import FastAPI, Request
+from redis.exceptions import RedisError
+from starlette.responses import JSONResponse, PlainTextResponse
+
+from foxglove.cache import cached_response, coalesce_requests
+from foxglove.exceptions import HttpNotFound
+from foxglove.testing import TestClient as Client
+
+
+def create_app(calls):
+    app = FastAPI()
+
+    @app.get('/data/')
+    @cached_response(60, stale_ttl=60, key_prefix='data')
+    async def data(request: Request, v: int = 0):
+        calls.append(v)
+        return {'v': v, 'calls': len(calls)}
+
+    @app.get('/text/')
+    @cached_response(60, vary_query=['a'], vary_headers=['X-Version'])
+    def text(request: Request):
+        calls.append('text')
+        return PlainTextResponse(f'calls: {len(calls)}', headers={'custom': 'header'})
+
+    @app.get('/error/')
+    @cached_response(60)
+    async def error(request: Request):
+        calls.append('error')
+        return PlainTextResponse('error', status_code=400)
+
+    return app
+
+
+@pytest.fixture(name='cache_client')
+def _fix_cache_client(settings, glove, loop):
+    calls = []
+    with Client(create_app(calls), loop=loop) as client:
+        client.calls = calls
+        yield client
+
+
+def test_cache_hit(cache_client: Client):
+    r = cache_client.get('/data/')
+    assert r.status_code == 200, r.text
+    assert r.json() == {'v': 0, 'calls': 1}
+    assert r.headers['x-cache'] == 'miss'
+
+    r = cache_client.get('/data/')
+    assert r.status_code == 200, r.text
+    assert r.json() == {'v': 0, 'calls': 1}
+    assert r.headers['x-cache'] == 'hit'
+    assert r.headers['content-type'] == 'application/json'
+
+    r = cache_client.get('/data/?v=1')
+    assert r.json() == {'v': 1, 'calls': 2}
+    assert r.headers['x-cache'] == 'miss'
+    assert cache_client.calls == [0, 1]
+
+
+def test_cache_vary(cache_client: Client):
+    assert cache_client.get('/text/').text == 'calls: 1'
+    r = cache_client.get('/text/?b=1')
+    assert r.text == 'calls: 1'
+    assert r.headers['custom'] == 'header'
+    assert r.headers['x-cache'] == 'hit'
+    assert cache_client.get('/text/?a=1').text == 'calls: 2'
+    assert cache_client.get('/text/?a=1', headers={'x-version': '2'}).text == 'calls: 3'
+    assert cache_client.get('/text/?a=1&b=2', headers={'x-version': '2'}).text == 'calls: 3'
+
+
+def test_cache_error_not_cached(cache_client: Client):
+    assert cache_client.get('/error/').status_code == 400
+    assert cache_client.get('/error/').status_code == 400
+    assert cache_client.calls == ['error', 'error']
+
+
+def test_cache_stale(cache_client: Client, glove, loop, mocker):
+    assert cache_client.get('/data/').headers['x-cache'] == 'miss'
+
+    mocker.patch('foxglove.cache.time', return_value=time() + 100)
+    keys = loop.run_until_complete(glove.redis.keys('cache:data:*'))
+    assert len(keys) == 1
+    # as if another request is already updating the response
+    loop.run_until_complete(glove.redis.set(keys[0] + b':lock', b'1'))
+    r = cache_client.get('/data/')
+    assert r.json() == {'v': 0, 'calls': 1}
+    assert r.headers['x-cache'] == 'stale'
+
+    loop.run_until_complete(glove.redis.delete(keys[0] + b':lock'))
+    r = cache_client.get('/data/')
+    assert r.json() == {'v': 0, 'calls': 2}
+    assert r.headers['x-cache'] == 'miss'
+    assert loop.run_until_complete(glove.redis.exists(keys[0] + b':lock')) == 0
+
+
+def test_cache_wait(cache_client: Client, glove, loop):
+    async def set_later(key: bytes):
+        await glove.redis.set(key + b':lock', b'1')
+        r = await glove.redis.get(key)
+        loop.call_later(0.1, lambda: loop.create_task(glove.redis.set(key, r)))
+        await glove.redis.delete(key)
+
+    assert cache_client.get('/data/').headers['x-cache'] == 'miss'
+    (key,) = loop.run_until_complete(glove.redis.keys('cache:data:*'))
+    loop.run_until_complete(set_later(key))
+
+    r = cache_client.get('/data/')
+    assert r.json() == {'v': 0, 'calls': 1}
+    assert r.headers['x-cache'] == 'hit'
+
+
+async def test_coalesce(create_request):
+    calls = []
+    event = asyncio.Event()
+
+    @coalesce_requests()
+    async def view(request: Request):
+        calls.append(request.url.path)
+        await event.wait()
+        response = JSONResponse({'calls': len(calls)})
+        response.set_cookie('foo', 'bar')
+        return response
+
+    tasks = [asyncio.create_task(view(request=create_request(path='/foo/'))) for _ in range(3)]
+    tasks.append(asyncio.create_task(view(request=create_request(path='/bar/'))))
+    tasks.append(asyncio.create_task(view(request=create_request(path='/foo/', headers={'cookie': 'a=b'}))))
+    await asyncio.sleep(0)
+    event.set()
+    responses = await asyncio.gather(*tasks)
+    assert calls == ['/foo/', '/bar/', '/foo/']
+    assert [r.body for r in responses] == [b'{"calls":3}'] * 5
+    assert ['set-cookie' in r.headers for r in responses] == [True, False, False, True, True]
+    assert len({id(r) for r in responses}) == 5
+
+    response = await view(request=create_request(path='/foo/'))
+    assert calls == ['/foo/', '/bar/', '/foo/', '/foo/']
+    assert response.body == b'{"calls":4}'
+
+
+async def test_coalesce_not_get(create_request):
+    calls = []
+
+    @coalesce_requests(key=lambda request: 'same')
+    def view(request: Request):
+        calls.append(request.method)
+        return {'method': request.method}
+
+    responses = await asyncio.gather(*[view(request=create_request(method='POST')) for _ in range(3)])
+    assert calls == ['POST', 'POST', 'POST']
+    assert [r.body for r in responses] == [b'{"method":"POST"}'] * 3
+
+
+async def test_coalesce_error(create_request):
+    calls = []
+
+    @coalesce_requests()
+    async def view(request: Request):
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise HttpNotFound('missing')
+
+    results = await asyncio.gather(*[view(request=create_request()) for _ in range(2)], return_exceptions=True)
+    assert calls == [1]
+    assert [str(r) for r in results] == ['HttpNotFound(404): missing'] * 2
+
+
+async def test_coalesce_cancelled(create_request):
+    calls = []
+
+    @coalesce_requests()
+    async def view(request: Request):
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {'calls': len(calls)}
+
+    first = asyncio.create_task(view(request=create_request()))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(view(request=create_request()))
+    await asyncio.sleep(0)
+    first.cancel()
+    response = await second
+    assert response.body == b'{"calls":2}'
+    assert calls == [1, 1]
+
+
+def test_cache_redis_error(cache_client: Client, glove, mocker, caplog):
+    set_ = glove.redis.set
+
+    async def set_lock_only(name, value, **kwargs):
+        if kwargs.get('nx'):
+            return await set_(name, value, **kwargs)
+        raise RedisError('storing failed')
+
+    mocker.patch.object(glove.redis, 'set', side_effect=set_lock_only)
+    r = cache_client.get('/data/')
+    assert r.status_code == 200, r.text
+    assert r.json() == {'v': 0, 'calls': 1}
+    assert r.headers['x-cache'] == 'miss'
+    # the lock was still released
+    assert cache_client.get('/data/').json() == {'v': 0, 'calls': 2}
+
+    mocker.patch.object(glove.redis, 'set', side_effect=RedisError('redis down'))
+    r = cache_client.get('/data/')
+    assert r.status_code == 200, r.text
+    assert r.json() == {'v': 0, 'calls': 3}
+    assert 'x-cache' not in r.headers
+
+    mocker.patch.object(glove.redis, 'delete', side_effect=RedisError('redis down'))
+    mocker.patch.object(glove.redis, 'set', side_effect=set_lock_only)
+    assert cache_client.get('/text/').status_code == 200
+
+    assert [r.message for r in caplog.records if r.name == 'foxglove.cache'] == [
+        'error caching response, RedisError: storing failed',
+        'error caching response, RedisError: storing failed',
+        'error getting cached response, RedisError: redis down',
+        'error caching response, RedisError: storing failed',
+        'error releasing cache lock, RedisError: redis down',
+    ]
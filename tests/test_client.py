@@ -45,6 +45,17 @@ def test_errors_raise_unexpected(client: Client, caplog):
     assert r.extra['response_body'] == {'message': 'raised HttpBadRequest'}
 
 
+def test_errors_streaming_truncated(client: Client, settings, caplog):
+    r = client.get('/stream-error/', params={'size': 50_000})
+    assert r.status_code == 500, r.text
+    # the response itself isn't truncated
+    assert r.text == 'x' * 50_000
+    assert len(caplog.records) == 1, caplog.text
+    assert '"GET /stream-error/?size=50000", unexpected response: 500' in caplog.text
+    response_body = caplog.records[0].extra['response_body']
+    assert response_body == b'x' * settings.log_max_body_size + b'...[truncated]'
+
+
 def test_errors_exception(client: Client, caplog):
     r = client.get('/error/', params={'error': 'RuntimeError'})
     assert r.status_code == 500, r.text
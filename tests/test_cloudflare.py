@@ -0,0 +1,254 @@
+import asyncio
+import logging
+from ipaddress import ip_address
+
+import pytest
+
+from foxglove.cloudflare import CloudflareIPs, IPRangeTable
+from foxglove.exceptions import UnexpectedResponse
+from foxglove.testing import DummyServer
+
+
+@pytest.mark.parametrize(
+    'ip,result',
+    [
+        ('162.158.0.0', True),
+        ('162.158.186.183', True),
+        ('162.159.255.255', True),
+        ('162.160.0.0', False),
+        ('162.157.255.255', False),
+        ('104.16.0.0', True),
+        ('1.1.1.1', False),
+        ('0.0.0.0', False),
+        ('255.255.255.255', False),
+        ('2606:4700::6810:84e5', True),
+        ('2606:4701::', False),
+        ('::1', False),
+    ],
+)
+def test_ip_range_table_match(ip, result):
+    table = IPRangeTable(['162.158.0.0/15', '104.16.0.0/13', '2606:4700::/32'])
+    assert table.match(ip_address(ip)) is result
+
+
+def test_ip_range_table_counts():
+    table = IPRangeTable(['173.245.48.0/20', '162.158.0.0/15', '104.16.0.0/13', '2400:cb00::/32'])
+    assert len(table) == 4
+    for ip in '162.158.186.183', '104.16.0.0', '162.158.92.59', '2400:cb00::1', '8.8.8.8':
+        table.match(ip_address(ip))
+
+    assert list(table.counters) == [0, 2, 1, 1]
+    assert [repr(c) for c in table.hit_counts()] == [
+        'IPRangeCounter(162.158.0.0/15, 2)',
+        'IPRangeCounter(104.16.0.0/13, 1)',
+        'IPRangeCounter(2400:cb00::/32, 1)',
+        'IPRangeCounter(173.245.48.0/20, 0)',
+    ]
+    # order of the networks never changes
+    assert [str(n) for n in table.networks] == ['173.245.48.0/20', '162.158.0.0/15', '104.16.0.0/13', '2400:cb00::/32']
+
+
+def test_ip_range_table_nested():
+    table = IPRangeTable(['10.0.0.0/8', '10.1.0.0/16', '10.200.0.0/16'])
+    assert table.match(ip_address('10.1.2.3'))
+    assert table.match(ip_address('10.100.0.0'))
+    assert table.match(ip_address('10.255.255.255'))
+    assert not table.match(ip_address('11.0.0.0'))
+    assert list(table.counters) == [2, 1, 0]
+
+
+def test_ip_range_table_empty():
+    table = IPRangeTable([])
+    assert not table.match(ip_address('1.1.1.1'))
+    assert repr(table) == 'IPRangeTable([])'
+
+
+def test_load_snapshot(settings):
+    cf_ips = CloudflareIPs(settings)
+    assert len(cf_ips.table) == 22
+    assert cf_ips.age == float('inf')
+    assert cf_ips.table.match(ip_address('162.158.186.183'))
+
+
+def test_check_verdict_cache(settings):
+    cf_ips = CloudflareIPs(settings.model_copy(update=dict(cloudflare_verdict_cache_size=2)))
+    assert cf_ips.check(b'162.158.186.183')
+    assert cf_ips.check(b'162.158.186.183')
+    assert not cf_ips.check(b'1.1.1.1')
+    assert not cf_ips.check('foobar')
+    assert repr(cf_ips.verdicts) == 'VerdictCache(size=2, hits=1, misses=3)'
+    # hits from the cache are still counted against the network
+    assert repr(cf_ips.table.hit_counts()[0]) == 'IPRangeCounter(162.158.0.0/15, 2)'
+
+    # least recently used entry was evicted
+    assert cf_ips.check(b'162.158.186.183')
+    assert cf_ips.verdicts.misses == 4
+
+
+@pytest.fixture(name='cf_settings')
+def _fix_cf_settings(settings, dummy_server: DummyServer, tmp_path):
+    return settings.model_copy(
+        update=dict(
+            cloudflare_url=dummy_server.server_name,
+            cloudflare_ips_cache_path=tmp_path / 'cf_ips.txt',
+            # the dummy server only returns 3 ranges
+            cloudflare_ips_min_ranges=3,
+        )
+    )
+
+
+async def test_refresh(cf_settings, dummy_server: DummyServer, glove):
+    cf_ips = CloudflareIPs(cf_settings)
+    old_table = cf_ips.table
+    assert len(old_table) == 22
+
+    table = await cf_ips.refresh()
+    assert cf_ips.table is table
+    assert [str(n) for n in table.networks] == ['173.245.48.0/20', '103.21.244.0/22', '2400:cb00::/32']
+    assert sorted(dummy_server.log) == ['GET /ips-v4 > 200', 'GET /ips-v6 > 200']
+    assert cf_settings.cloudflare_ips_cache_path.read_text() == '173.245.48.0/20\n103.21.244.0/22\n2400:cb00::/32\n'
+
+    # a new worker starts with the cached ranges
+    cf_ips2 = CloudflareIPs(cf_settings)
+    assert len(cf_ips2.table) == 3
+    assert 0 <= cf_ips2.age < 10
+
+
+async def test_refresh_clears_verdicts(cf_settings, dummy_server: DummyServer, glove):
+    cf_ips = CloudflareIPs(cf_settings)
+    assert cf_ips.check(b'162.158.186.183')
+    assert cf_ips.check(b'173.245.48.1')
+    assert len(cf_ips.verdicts) == 2
+
+    await cf_ips.refresh()
+    assert len(cf_ips.verdicts) == 0
+    # 162.158.0.0/15 isn't in the new ranges
+    assert not cf_ips.check(b'162.158.186.183')
+    assert cf_ips.check(b'173.245.48.1')
+    assert repr(cf_ips.table.hit_counts()[0]) == 'IPRangeCounter(173.245.48.0/20, 1)'
+
+
+async def test_refresh_single_flight(cf_settings, dummy_server: DummyServer, glove):
+    cf_ips = CloudflareIPs(cf_settings)
+    t1, t2, t3 = await asyncio.gather(cf_ips.refresh(), cf_ips.refresh(), cf_ips.refresh())
+    assert t1 is t2 is t3 is cf_ips.table
+    assert len(dummy_server.log) == 2
+
+    await cf_ips.refresh()
+    assert len(dummy_server.log) == 4
+
+
+async def test_refresh_error(cf_settings, dummy_server: DummyServer, glove):
+    cf_ips = CloudflareIPs(cf_settings.model_copy(update=dict(cloudflare_url=f'{dummy_server.server_name}/status/500')))
+    table = cf_ips.table
+    with pytest.raises(UnexpectedResponse):
+        await cf_ips.refresh()
+    assert cf_ips.table is table
+    assert not cf_settings.cloudflare_ips_cache_path.exists()
+
+
+@pytest.mark.parametrize(
+    'networks',
+    [
+        [],
+        ['173.245.48.0/20', '103.21.244.0/22', '104.16.0.0/13'],
+        ['2400:cb00::/32', '2606:4700::/32', '2803:f800::/32'],
+        ['173.245.48.0/20', '2400:cb00::/32'],
+    ],
+)
+async def test_refresh_implausible(cf_settings, glove, mocker, networks):
+    async def get_cloudflare_ips(cloudflare_url):
+        return IPRangeTable(networks)
+
+    mocker.patch('foxglove.cloudflare.get_cloudflare_ips', get_cloudflare_ips)
+    cf_ips = CloudflareIPs(cf_settings)
+    table = cf_ips.table
+    with pytest.raises(
+        ValueError, match=f'implausible CloudFlare IPs, got {len(networks)} ranges, expected at least 3'
+    ):
+        await cf_ips.refresh()
+    assert cf_ips.table is table
+    assert not cf_settings.cloudflare_ips_cache_path.exists()
+
+
+async def test_invalid_cache(cf_settings, caplog):
+    cf_settings.cloudflare_ips_cache_path.write_text('foobar\n')
+    cf_ips = CloudflareIPs(cf_settings)
+    assert len(cf_ips.table) == 22
+    logs = [r.message for r in caplog.records if r.name == 'foxglove.cloudflare']
+    assert logs == [
+        f'invalid CloudFlare IPs cache file "{cf_settings.cloudflare_ips_cache_path}", '
+        "'foobar' does not appear to be an IPv4 or IPv6 network"
+    ]
+
+
+@pytest.mark.parametrize('cache', ['', '1.2.3.0/24\n1.2.4.0/24\n1.2.5.0/24\n', '1.2.3.0/24\n2400:cb00::/32\n'])
+async def test_implausible_cache(cf_settings, caplog, cache):
+    cf_settings.cloudflare_ips_cache_path.write_text(cache)
+    cf_ips = CloudflareIPs(cf_settings)
+    assert len(cf_ips.table) == 22
+    assert cf_ips.age == float('inf')
+    logs = [r.message for r in caplog.records if r.name == 'foxglove.cloudflare']
+    assert logs == [
+        f'invalid CloudFlare IPs cache file "{cf_settings.cloudflare_ips_cache_path}", '
+        f'got {len(cache.split())} ranges, expected at least 3 including IPv4 and IPv6 ranges'
+    ]
+
+
+async def test_unreadable_cache(cf_settings, caplog):
+    cf_settings.cloudflare_ips_cache_path.mkdir()
+    cf_ips = CloudflareIPs(cf_settings)
+    assert len(cf_ips.table) == 22
+    assert cf_ips.age == float('inf')
+    logs = [r.message for r in caplog.records if r.name == 'foxglove.cloudflare']
+    assert len(logs) == 1
+    assert logs[0].startswith(f'invalid CloudFlare IPs cache file "{cf_settings.cloudflare_ips_cache_path}", ')
+
+
+async def test_refresh_loop_implausible_cache(cf_settings, dummy_server: DummyServer, glove):
+    cf_settings.cloudflare_ips_cache_path.write_text('')
+    cf_ips = CloudflareIPs(cf_settings.model_copy(update=dict(cloudflare_ips_refresh_interval=3600)))
+    cf_ips.start()
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if len(cf_ips.table) == 3:
+            break
+    await cf_ips.stop()
+    # the empty cache file is ignored and the ranges are refreshed immediately
+    assert len(cf_ips.table) == 3
+    assert cf_settings.cloudflare_ips_cache_path.read_text() == '173.245.48.0/20\n103.21.244.0/22\n2400:cb00::/32\n'
+
+
+async def test_refresh_loop(cf_settings, dummy_server: DummyServer, glove, caplog):
+    caplog.set_level(logging.INFO, 'foxglove.cloudflare')
+    cf_ips = CloudflareIPs(cf_settings.model_copy(update=dict(cloudflare_ips_refresh_interval=3600)))
+    cf_ips.start()
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if len(cf_ips.table) == 3:
+            break
+    assert len(cf_ips.table) == 3
+    logs = [r.message for r in caplog.records if r.name == 'foxglove.cloudflare']
+    assert logs == ['downloaded 3 IPs from CloudFlare to check requests against']
+    await cf_ips.stop()
+    assert len(dummy_server.log) == 2
+
+
+async def test_refresh_loop_recent_cache(cf_settings, dummy_server: DummyServer, glove):
+    cf_settings.cloudflare_ips_cache_path.write_text('1.2.3.0/24\n1.2.4.0/24\n2400:cb00::/32\n')
+    cf_ips = CloudflareIPs(cf_settings.model_copy(update=dict(cloudflare_ips_refresh_interval=3600)))
+    cf_ips.start()
+    await asyncio.sleep(0.05)
+    await cf_ips.stop()
+    assert [str(n) for n in cf_ips.table.networks] == ['1.2.3.0/24', '1.2.4.0/24', '2400:cb00::/32']
+    assert dummy_server.log == []
+
+
+async def test_glove_startup(settings, glove):
+    assert not hasattr(glove, '_cloudflare_ips')
+    settings.cloudflare_check = True
+    try:
+        await glove.startup()
+        assert len(glove._cloudflare_ips.table) == 22
+    finally:
+        settings.cloudflare_check = False
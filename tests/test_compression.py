@@ -0,0 +1,205 @@
+import gzip
+import zlib
+
+import pytest
+from fastapi import FastAPI
+from starlette.middleware import Middleware
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+
+from foxglove.compression import CompressionMiddleware, PrecompressedStaticFiles, choose_encoding
+from foxglove.testing import TestClient as Client
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+big_text = 'this is a test. ' * 100
+
+
+def create_app(**kwargs) -> FastAPI:
+    app = FastAPI(middleware=[Middleware(CompressionMiddleware, **kwargs)])
+
+    @app.get('/json/')
+    async def json_view(size: int = 100):
+        return {'items': ['x' * 10] * size}
+
+    @app.get('/text/')
+    async def text_view():
+        return PlainTextResponse(big_text)
+
+    @app.get('/image/')
+    async def image_view():
+        return Response(b'\x89PNG' + b'x' * 1000, media_type='image/png')
+
+    @app.get('/encoded/')
+    async def encoded_view():
+        return Response(gzip.compress(big_text.encode()), media_type='text/plain', headers={'content-encoding': 'gzip'})
+
+    @app.get('/etag/')
+    async def etag_view():
+        return PlainTextResponse(big_text, headers={'etag': '"abc"'})
+
+    @app.get('/stream/')
+    async def stream_view():
+        async def stream():
+            for i in range(10):
+                yield f'chunk {i} ' * 20
+
+        return StreamingResponse(stream(), media_type='text/plain')
+
+    return app
+
+
+@pytest.fixture(name='compression_client')
+def _fix_compression_client(settings, loop):
+    with Client(create_app(use_brotli=False), loop=loop) as client:
+        yield client
+
+
+@pytest.mark.parametrize(
+    'accept_encoding,encodings,expected',
+    [
+        (b'gzip', ('br', 'gzip'), 'gzip'),
+        (b'gzip, deflate, br', ('br', 'gzip'), 'br'),
+        (b'gzip, deflate, br', ('gzip',), 'gzip'),
+        (b'GZip;q=0.5, br;q=0', ('br', 'gzip'), 'gzip'),
+        (b'br;q=0, gzip;q=0', ('br', 'gzip'), None),
+        (b'*', ('br', 'gzip'), 'br'),
+        (b'identity', ('br', 'gzip'), None),
+        (b'gzip;q=foo', ('br', 'gzip'), None),
+        (b'', ('br', 'gzip'), None),
+        (b'*, br;q=0', ('br', 'gzip'), 'gzip'),
+        (b'*, gzip;q=0', ('gzip',), None),
+    ],
+)
+def test_choose_encoding(accept_encoding, encodings, expected):
+    assert choose_encoding(accept_encoding, encodings) == expected
+
+
+def test_gzip_json(compression_client: Client):
+    r = compression_client.get('/json/', headers={'accept-encoding': 'gzip'}, stream=True)
+    assert r.status_code == 200, r.text
+    assert r.headers['content-encoding'] == 'gzip'
+    assert r.headers['vary'] == 'Accept-Encoding'
+    body = r.raw.read(decode_content=False)
+    assert int(r.headers['content-length']) == len(body)
+    assert len(body) < 100
+    assert gzip.decompress(body) == b'{"items":[' + b','.join([b'"xxxxxxxxxx"'] * 100) + b']}'
+
+
+def test_small(compression_client: Client):
+    r = compression_client.get('/json/?size=2', headers={'accept-encoding': 'gzip'})
+    assert r.status_code == 200, r.text
+    assert 'content-encoding' not in r.headers
+    assert 'vary' not in r.headers
+    assert r.json() == {'items': ['xxxxxxxxxx', 'xxxxxxxxxx']}
+
+
+@pytest.mark.parametrize('path', ['/image/', '/encoded/'])
+def test_not_compressed(compression_client: Client, path):
+    r = compression_client.get(path, headers={'accept-encoding': 'gzip'}, stream=True)
+    assert r.status_code == 200, r.text
+    assert 'vary' not in r.headers
+    assert len(r.raw.read(decode_content=False)) == int(r.headers['content-length'])
+
+
+def test_not_accepted(compression_client: Client):
+    r = compression_client.get('/text/', headers={'accept-encoding': 'identity'})
+    assert r.status_code == 200, r.text
+    assert 'content-encoding' not in r.headers
+    assert r.text == big_text
+
+
+def test_streaming(compression_client: Client):
+    r = compression_client.get('/stream/', headers={'accept-encoding': 'gzip'}, stream=True)
+    assert r.status_code == 200, r.text
+    assert r.headers['content-encoding'] == 'gzip'
+    assert 'content-length' not in r.headers
+    body = r.raw.read(decode_content=False)
+    assert zlib.decompress(body, zlib.MAX_WBITS | 16) == ''.join(f'chunk {i} ' * 20 for i in range(10)).encode()
+
+
+def test_weak_etag(compression_client: Client):
+    r = compression_client.get('/etag/', headers={'accept-encoding': 'gzip'})
+    assert r.status_code == 200, r.text
+    assert r.headers['content-encoding'] == 'gzip'
+    assert r.headers['etag'] == 'W/"abc"'
+
+    r = compression_client.get('/etag/', headers={'accept-encoding': 'identity'})
+    assert r.headers['etag'] == '"abc"'
+
+
+async def test_streaming_flush():
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'text/event-stream')]})
+        for i in range(3):
+            await send({'type': 'http.response.body', 'body': f'data: {i}\n\n'.encode(), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    # event-stream isn't compressed by default, force it to check each chunk can be decompressed as it arrives
+    middleware = CompressionMiddleware(app, use_brotli=False)
+    middleware.should_compress = lambda message: True
+    scope = {'type': 'http', 'headers': [(b'accept-encoding', b'gzip')]}
+    await middleware(scope, None, send)
+
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    chunks = [decompressor.decompress(m['body']) for m in sent[1:]]
+    assert chunks == [b'data: 0\n\n', b'data: 1\n\n', b'data: 2\n\n', b'']
+
+
+@pytest.mark.skipif(brotli is None, reason='brotli not installed')
+def test_brotli(settings, loop):
+    with Client(create_app(), loop=loop) as client:
+        r = client.get('/text/', headers={'accept-encoding': 'gzip, br'}, stream=True)
+    assert r.status_code == 200, r.text
+    assert r.headers['content-encoding'] == 'br'
+    assert brotli.decompress(r.raw.read(decode_content=False)) == big_text.encode()
+
+
+@pytest.fixture(name='static_client')
+def _fix_static_client(settings, loop, tmp_path):
+    (tmp_path / 'app.js').write_text('console.log("original")')
+    (tmp_path / 'app.js.gz').write_bytes(gzip.compress(b'console.log("gzip")'))
+    (tmp_path / 'other.css').write_text('body {}')
+    app = FastAPI()
+    app.mount('/static', PrecompressedStaticFiles(directory=tmp_path), name='static')
+    with Client(app, loop=loop) as client:
+        yield client
+
+
+def test_precompressed_static(static_client: Client):
+    r = static_client.get('/static/app.js', headers={'accept-encoding': 'gzip, br'})
+    assert r.status_code == 200, r.text
+    assert r.headers['content-encoding'] == 'gzip'
+    assert r.headers['content-type'].startswith('text/javascript')
+    assert r.headers['vary'] == 'Accept-Encoding'
+    assert r.text == 'console.log("gzip")'
+
+    r2 = static_client.get('/static/app.js', headers={'accept-encoding': 'gzip', 'if-none-match': r.headers['etag']})
+    assert r2.status_code == 304, r2.text
+
+    r = static_client.get('/static/app.js', headers={'accept-encoding': 'identity'})
+    assert r.status_code == 200, r.text
+    assert 'content-encoding' not in r.headers
+    assert r.headers['vary'] == 'Accept-Encoding'
+    assert r.text == 'console.log("original")'
+
+
+def test_precompressed_static_missing(static_client: Client):
+    r = static_client.get('/static/other.css', headers={'accept-encoding': 'gzip'})
+    assert r.status_code == 200, r.text
+    assert 'content-encoding' not in r.headers
+    assert r.text == 'body {}'
+
+    r = static_client.get('/static/missing.js', headers={'accept-encoding': 'gzip'})
+    assert r.status_code == 404, r.text
+
+    r = static_client.get('/static/app.js.gz', headers={'accept-encoding': 'gzip'})
+    assert r.status_code == 200, r.text
+    assert 'content-encoding' not in r.headers
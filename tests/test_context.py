@@ -0,0 +1,99 @@
+import logging
+from time import time
+
+import httpx
+from fastapi import FastAPI
+from starlette.middleware import Middleware
+
+from foxglove.context import (
+    RequestContext,
+    RequestContextFilter,
+    RequestContextMiddleware,
+    add_request_id_header,
+    get_request_id,
+    request_context,
+)
+from foxglove.logs import build_logging_config
+from foxglove.testing import TestClient as Client
+
+logger = logging.getLogger('test.context')
+
+
+def create_app(**kwargs) -> FastAPI:
+    app = FastAPI(middleware=[Middleware(RequestContextMiddleware, **kwargs)])
+
+    @app.get('/users/{user_id}/')
+    async def get_user(user_id: int):
+        ctx = request_context.get()
+        logger.warning('getting user %d', user_id)
+        return {'request_id': get_request_id(), 'route': ctx.route, 'ip': ctx.ip}
+
+    return app
+
+
+def test_request_id_generated(settings, loop):
+    with Client(create_app(), loop=loop) as client:
+        r = client.get('/users/123/')
+    assert r.status_code == 200, r.text
+    obj = r.json()
+    assert len(obj['request_id']) == 32
+    assert r.headers['x-request-id'] == obj['request_id']
+    assert obj == {'request_id': obj['request_id'], 'route': '/users/{user_id}/', 'ip': 'testclient'}
+    assert get_request_id() is None
+
+
+def test_request_id_from_header(settings, loop):
+    with Client(create_app(response_header=False), loop=loop) as client:
+        r = client.get('/users/123/', headers={'x-request-id': 'abc-123', 'x-forwarded-for': '1.2.3.4, 5.6.7.8'})
+        assert r.json() == {'request_id': 'abc-123', 'route': '/users/{user_id}/', 'ip': '1.2.3.4'}
+        assert 'x-request-id' not in r.headers
+
+        r = client.get('/users/123/', headers={'x-request-id': 'foo bar'})
+        assert len(r.json()['request_id']) == 32
+
+
+def test_filter(settings, loop, caplog):
+    caplog.handler.addFilter(RequestContextFilter())
+    with Client(create_app(), loop=loop) as client:
+        r = client.get('/users/123/', headers={'x-request-id': 'abc-123'})
+    assert r.status_code == 200, r.text
+    records = [r for r in caplog.records if r.name == 'test.context']
+    assert len(records) == 1
+    assert records[0].request_id == 'abc-123'
+    assert records[0].request_route == '/users/{user_id}/'
+    assert records[0].request_ip == 'testclient'
+    assert 0 <= time() - records[0].request_start < 5
+
+    logger.warning('outside a request')
+    assert not hasattr(caplog.records[-1], 'request_id')
+
+
+def test_start_time():
+    ctx = RequestContext({'type': 'http', 'headers': []}, received_at=123.0)
+    assert ctx.start_time == 123.0
+    ctx = RequestContext({'type': 'http', 'headers': [(b'x-request-start', b'1600000000123')]}, received_at=123.0)
+    assert ctx.start_time == 1600000000.123
+    ctx = RequestContext({'type': 'http', 'headers': [(b'x-request-start', b'foobar')]}, received_at=123.0)
+    assert ctx.start_time == 123.0
+
+
+def test_logging_config_filter(settings):
+    config = build_logging_config()
+    assert config['handlers']['foxglove.default']['filters'] == ['foxglove.request_context']
+
+
+async def test_add_request_id_header():
+    request = httpx.Request('GET', 'https://example.com')
+    await add_request_id_header(request)
+    assert 'x-request-id' not in request.headers
+
+    token = request_context.set(RequestContext({'type': 'http', 'headers': []}, 'abc-123'))
+    try:
+        await add_request_id_header(request)
+        assert request.headers['x-request-id'] == 'abc-123'
+
+        request = httpx.Request('GET', 'https://example.com', headers={'x-request-id': 'other'})
+        await add_request_id_header(request)
+        assert request.headers['x-request-id'] == 'other'
+    finally:
+        request_context.reset(token)
@@ -1,9 +1,11 @@
 import logging
+from collections import Counter
 
-from buildpg.asyncpg import BuildPgConnection
+import pytest
+from buildpg.asyncpg import BuildPgConnection, BuildPgPool
 from dirty_equals import IsNow, IsPositiveInt
 
-from foxglove.db import prepare_database
+from foxglove.db import HashRing, prepare_database
 from foxglove.db.utils import AsyncPgContext
 from foxglove.redis import async_flush_redis, flush_redis
 from foxglove.settings import BaseSettings
@@ -111,3 +113,70 @@ async def test_async_flush_redis(settings, glove):
     assert len(await glove.redis.keys('*')) == 2
     await async_flush_redis(settings)
     assert len(await glove.redis.keys('*')) == 0
+
+
+async def test_glove_read_replica(settings, glove, mocker, caplog):
+    caplog.set_level(logging.INFO)
+    # the primary stands in for the replica, it's never lagging
+    mocker.patch.object(settings, 'pg_read_dsn', settings.pg_dsn)
+    await glove.startup()
+    assert await glove.replica_monitor.check() is True
+    assert glove.replica_monitor.lag == 0
+    async with glove.pg_read.acquire() as conn:
+        assert await conn.fetchval('select 1') == 1
+
+    mocker.patch.object(settings, 'pg_read_max_lag', -1)
+    assert await glove.replica_monitor.check() is False
+    mocker.patch.object(settings, 'pg_read_max_lag', None)
+    assert await glove.replica_monitor.check() is True
+    assert [r.message for r in caplog.records if r.name == 'foxglove.db'] == [
+        'read replica unavailable, using the primary for reads, replication lag 0.0s',
+        'read replica available, replication lag 0.0s',
+    ]
+
+    await glove.shutdown()
+    assert not hasattr(glove, 'pg_read')
+    assert not hasattr(glove, 'replica_monitor')
+
+
+def test_hash_ring():
+    ring = HashRing(['one', 'two', 'three'])
+    assert repr(ring) == "HashRing(['one', 'two', 'three'])"
+    assert ring.node(123) == ring.node('123') == HashRing(['three', 'one', 'two']).node(123)
+    counts = Counter(ring.node(i) for i in range(3000))
+    assert set(counts) == {'one', 'two', 'three'}
+    assert all(600 < c < 1400 for c in counts.values()), counts
+
+    # adding a node only moves keys to the new node
+    bigger = HashRing(['one', 'two', 'three', 'four'])
+    moved = [i for i in range(3000) if bigger.node(i) != ring.node(i)]
+    assert 300 < len(moved) < 1200
+    assert {bigger.node(i) for i in moved} == {'four'}
+
+    with pytest.raises(ValueError, match='hash ring has no nodes'):
+        HashRing([]).node(1)
+
+
+async def test_glove_shards(settings, glove, mocker):
+    mocker.patch.object(settings, 'pg_shards', {'one': settings.pg_dsn, 'two': settings.pg_dsn})
+    await glove.startup()
+    assert set(glove.pg_shards) == {'one', 'two'}
+    assert glove.shard_ring.nodes == ['one', 'two']
+    async with glove.pg_shards['two'].acquire() as conn:
+        assert await conn.fetchval('select 1') == 1
+
+    await glove.shutdown()
+    assert not hasattr(glove, 'pg_shards')
+    assert not hasattr(glove, 'shard_ring')
+
+
+async def test_glove_shards_error(settings, glove, mocker):
+    mocker.patch.object(settings, 'pg_read_dsn', settings.pg_dsn)
+    mocker.patch.object(settings, 'pg_shards', {'one': settings.pg_dsn, 'down': 'postgres://postgres@localhost:1/x'})
+    close = mocker.spy(BuildPgPool, 'close')
+    with pytest.raises(OSError):
+        await glove.startup()
+    # the pools which were created are closed
+    assert close.call_count == 2
+    assert not hasattr(glove, 'pg_read')
+    assert not hasattr(glove, 'pg_shards')
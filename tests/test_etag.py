@@ -0,0 +1,120 @@
+import pytest
+from fastapi import FastAPI, Request
+from starlette.middleware import Middleware
+from starlette.responses import Response, StreamingResponse
+
+from foxglove.etag import ETagMiddleware, etag, etag_matches, weak_etag
+from foxglove.testing import TestClient as Client
+
+
+def create_app(**kwargs) -> FastAPI:
+    from foxglove.templates import FoxgloveTemplates
+
+    app = FastAPI(middleware=[Middleware(ETagMiddleware, **kwargs)])
+    templates = FoxgloveTemplates()
+
+    @app.get('/marked/')
+    @etag
+    async def marked(name: str = 'foo'):
+        return {'name': name}
+
+    @app.get('/unmarked/')
+    async def unmarked():
+        return {'name': 'foo'}
+
+    @app.get('/has-etag/')
+    @etag
+    async def has_etag():
+        return Response('foo', headers={'etag': '"custom"'})
+
+    @app.get('/stream/')
+    @etag
+    async def stream():
+        return StreamingResponse(c for c in ['foo', 'bar'])
+
+    @app.get('/error/')
+    @etag
+    async def error():
+        return Response('error', status_code=400)
+
+    @app.get('/template/')
+    @templates.render('foobar.jinja', etag=True)
+    async def template(request: Request):
+        return {'name': 'Samuel'}
+
+    return app
+
+
+@pytest.fixture(name='etag_client')
+def _fix_etag_client(settings, loop):
+    with Client(create_app(), loop=loop) as client:
+        yield client
+
+
+def test_weak_etag():
+    assert weak_etag(b'foobar') == b'W/"9ef61f95-6"'
+    assert weak_etag(b'') == b'W/"00000000-0"'
+
+
+@pytest.mark.parametrize(
+    'if_none_match,expected',
+    [
+        (b'W/"9ef61f95-6"', True),
+        (b'"9ef61f95-6"', True),
+        (b'"other", W/"9ef61f95-6"', True),
+        (b'*', True),
+        (b'"other"', False),
+        (b'W/"9ef61f95-7"', False),
+    ],
+)
+def test_etag_matches(if_none_match, expected):
+    assert etag_matches(if_none_match, b'W/"9ef61f95-6"') == expected
+
+
+def test_etag_not_modified(etag_client: Client):
+    r = etag_client.get('/marked/')
+    assert r.status_code == 200, r.text
+    assert r.json() == {'name': 'foo'}
+    etag_value = r.headers['etag']
+    assert etag_value == weak_etag(b'{"name":"foo"}').decode()
+
+    r = etag_client.get('/marked/', headers={'if-none-match': etag_value})
+    assert r.status_code == 304, r.text
+    assert r.content == b''
+    assert r.headers['etag'] == etag_value
+    assert 'content-type' not in r.headers
+
+    r = etag_client.get('/marked/?name=bar', headers={'if-none-match': etag_value})
+    assert r.status_code == 200, r.text
+    assert r.json() == {'name': 'bar'}
+    assert r.headers['etag'] != etag_value
+
+
+def test_etag_template(etag_client: Client):
+    r = etag_client.get('/template/')
+    assert r.status_code == 200, r.text
+    assert r.text == '<p>Hello Samuel</p>'
+    etag_value = r.headers['etag']
+
+    r = etag_client.get('/template/', headers={'if-none-match': etag_value})
+    assert r.status_code == 304, r.text
+
+
+@pytest.mark.parametrize('path', ['/unmarked/', '/stream/', '/error/'])
+def test_etag_not_added(etag_client: Client, path):
+    r = etag_client.get(path)
+    assert 'etag' not in r.headers
+
+
+def test_etag_existing(etag_client: Client):
+    r = etag_client.get('/has-etag/', headers={'if-none-match': '"other"'})
+    assert r.status_code == 200, r.text
+    assert r.headers['etag'] == '"custom"'
+
+
+def test_etag_all_routes(settings, loop):
+    with Client(create_app(all_routes=True), loop=loop) as client:
+        r = client.get('/unmarked/')
+        assert r.status_code == 200, r.text
+        r = client.get('/unmarked/', headers={'if-none-match': r.headers['etag']})
+        assert r.status_code == 304, r.text
@@ -1,7 +1,7 @@
 import pytest
 from httpx import Request as HttpxRequest, Response as HttpxResponse
 
-from foxglove.exceptions import UnexpectedResponse
+from foxglove.exceptions import HttpServiceUnavailable, UnexpectedResponse
 
 
 def test_unexpected_response_ok(settings):
@@ -16,3 +16,10 @@ def test_unexpected_response_error(settings):
     assert repr(exc_info.value) == (
         'UnexpectedResponse("GET https://example.com, unexpected response: 403:\n{\n  "foo": 1\n}")'
     )
+
+
+def test_service_unavailable_headers():
+    headers = {'X-Foo': 'bar'}
+    e = HttpServiceUnavailable('busy', retry_after=2, headers=headers)
+    assert e.headers == {'X-Foo': 'bar', 'Retry-After': '2'}
+    assert headers == {'X-Foo': 'bar'}
@@ -0,0 +1,74 @@
+import asyncio
+
+from foxglove.context import RequestContext, get_request_id, request_context
+from foxglove.logs import LogQueue
+
+
+async def test_log_queue():
+    results = []
+
+    async def job(v):
+        await asyncio.sleep(0)
+        results.append(v)
+
+    q = LogQueue(10)
+    assert q.put(job, 1)
+    assert q.put(job, 2)
+    assert len(q) == 2
+    assert results == []
+    await q.close()
+    assert results == [1, 2]
+    assert len(q) == 0
+
+
+async def test_log_queue_overflow(caplog):
+    results = []
+
+    async def job(v):
+        results.append(v)
+
+    q = LogQueue(2)
+    assert [q.put(job, i) for i in range(5)] == [True, True, False, False, False]
+    assert q.dropped == 3
+    await q.close()
+    assert results == [0, 1]
+    logs = [r.message for r in caplog.records if r.name == 'foxglove.logs']
+    # the warning is rate limited
+    assert logs == ['log queue full, 1 jobs dropped (1 total)', 'log queue closed, 3 jobs were dropped']
+
+
+async def test_log_queue_error(caplog):
+    results = []
+
+    async def job(v):
+        if v == 1:
+            raise RuntimeError('broken')
+        results.append(v)
+
+    q = LogQueue(10)
+    for i in range(3):
+        q.put(job, i)
+    await q.close()
+    assert results == [0, 2]
+    logs = [r.message for r in caplog.records if r.name == 'foxglove.logs']
+    assert logs == ['error running background logging job']
+
+
+async def test_log_queue_close_unused():
+    await LogQueue(10).close()
+
+
+async def test_log_queue_request_context():
+    results = []
+
+    async def job():
+        results.append(get_request_id())
+
+    q = LogQueue(10)
+    for request_id in 'first', 'second':
+        token = request_context.set(RequestContext({'type': 'http', 'headers': []}, request_id))
+        q.put(job)
+        request_context.reset(token)
+    q.put(job)
+    await q.close()
+    assert results == ['first', 'second', None]
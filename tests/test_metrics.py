@@ -0,0 +1,185 @@
+import asyncio
+import json
+import os
+from time import time
+
+from fastapi import Depends, FastAPI
+from starlette.middleware import Middleware
+
+import foxglove
+from foxglove.metrics import Histogram, Metrics, MetricsMiddleware
+from foxglove.testing import TestClient as Client
+
+
+def test_histogram():
+    h = Histogram((0.1, 1))
+    for v in 0.05, 0.1, 0.5, 2, 3:
+        h.observe(v)
+    assert list(h.counts) == [2, 1, 2]
+    assert h.count == 5
+    assert h.dump() == [2, 1, 2, 5.65]
+
+    h2 = Histogram((0.1, 1))
+    h2.load(h.dump())
+    h2.load(h.dump())
+    assert list(h2.counts) == [4, 2, 4]
+    assert h2.sum == 11.3
+
+
+def create_app() -> FastAPI:
+    from demo.main import app
+
+    metrics_app = FastAPI(
+        routes=app.routes,
+        middleware=[Middleware(MetricsMiddleware, path='/metrics')],
+        exception_handlers=app.exception_handlers,
+    )
+
+    @metrics_app.get('/users/{user_id}/')
+    async def get_user(user_id: int):
+        return {'user_id': user_id}
+
+    return metrics_app
+
+
+def test_metrics_middleware(settings, glove, loop):
+    with Client(create_app(), loop=loop) as client:
+        assert client.get_json('/') == {'app': 'foxglove-demo'}
+        for user_id in 1, 2, 3:
+            headers = {'x-request-start': str(int((time() - 0.2) * 1000))}
+            assert client.get_json(f'/users/{user_id}/', headers=headers) == {'user_id': user_id}
+        client.get_json('/error/', status=400)
+        client.get_json('/foobar/', status=404)
+
+        assert glove.metrics.in_flight == 0
+        r = client.get('/metrics')
+        assert r.status_code == 200, r.text
+        assert r.headers['content-type'] == 'text/plain; version=0.0.4; charset=utf-8'
+
+    lines = r.text.splitlines()
+    assert 'foxglove_requests_in_flight 0' in lines
+    assert [line for line in lines if line.startswith('foxglove_requests_total')] == [
+        'foxglove_requests_total{method="GET",route="/",status="200"} 1',
+        'foxglove_requests_total{method="GET",route="/error/",status="400"} 1',
+        'foxglove_requests_total{method="GET",route="/users/{user_id}/",status="200"} 3',
+        'foxglove_requests_total{method="GET",route="<unmatched>",status="404"} 1',
+    ]
+    # queue time is only recorded when the x-request-start header is set
+    queue_lines = [line for line in lines if line.startswith('foxglove_request_queue_seconds_')]
+    assert 'foxglove_request_queue_seconds_bucket{method="GET",route="/users/{user_id}/",le="0.1"} 0' in queue_lines
+    assert 'foxglove_request_queue_seconds_bucket{method="GET",route="/users/{user_id}/",le="0.25"} 3' in queue_lines
+    assert 'foxglove_request_queue_seconds_count{method="GET",route="/users/{user_id}/"} 3' in queue_lines
+    assert all('route="/users/{user_id}/"' in line for line in queue_lines)
+    assert 'foxglove_request_handler_seconds_count{method="GET",route="/"} 1' in lines
+    assert 'foxglove_request_handler_seconds_bucket{method="GET",route="/",le="+Inf"} 1' in lines
+
+
+def test_metrics_middleware_other_method(settings, glove, loop):
+    with Client(create_app(), loop=loop) as client:
+        for method in 'FOO', 'BAR', 'FOO':
+            r = client.request(method, '/')
+            assert r.status_code == 405, r.text
+        r = client.request('FOO', '/missing/')
+        assert r.status_code == 404, r.text
+        lines = client.get('/metrics').text.splitlines()
+
+    assert set(glove.metrics.routes) == {('other', '/'), ('other', '<unmatched>')}
+    assert [line for line in lines if line.startswith('foxglove_requests_total')] == [
+        'foxglove_requests_total{method="other",route="/",status="405"} 3',
+        'foxglove_requests_total{method="other",route="<unmatched>",status="404"} 1',
+    ]
+
+
+async def test_metrics_aggregate(tmp_path):
+    metrics = Metrics(tmp_path, write_interval=3600)
+    metrics.start()
+    try:
+        route = metrics.route('GET', '/')
+        route.handler.observe(0.01)
+        route.statuses[200] = 1
+
+        other = Metrics()
+        other.in_flight = 2
+        other_route = other.route('GET', '/')
+        other_route.handler.observe(0.02)
+        other_route.statuses.update({200: 2, 500: 1})
+        (tmp_path / '123.json').write_text(json.dumps(other.dump()))
+        # files which haven't been updated recently are ignored
+        (tmp_path / '456.json').write_text(json.dumps(other.dump()))
+        os.utime(tmp_path / '456.json', (0, 0))
+        (tmp_path / '789.json').write_text('broken')
+
+        lines = (await metrics.render_async()).splitlines()
+    finally:
+        await metrics.stop()
+
+    assert 'foxglove_requests_in_flight 2' in lines
+    assert 'foxglove_requests_total{method="GET",route="/",status="200"} 3' in lines
+    assert 'foxglove_requests_total{method="GET",route="/",status="500"} 1' in lines
+    assert 'foxglove_request_handler_seconds_count{method="GET",route="/"} 2' in lines
+    assert 'foxglove_request_handler_seconds_sum{method="GET",route="/"} 0.030000' in lines
+    # this process's file is removed on stop
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['123.json', '456.json', '789.json']
+
+
+async def test_metrics_remove_stale(tmp_path):
+    for name in '123.json', '.123.json.tmp', '456.json':
+        (tmp_path / name).write_text('{}')
+    os.utime(tmp_path / '123.json', (0, 0))
+    os.utime(tmp_path / '.123.json.tmp', (0, 0))
+
+    metrics = Metrics(tmp_path, write_interval=3600)
+    metrics.start()
+    try:
+        # this process's file is written by the background task
+        await asyncio.sleep(0)
+        assert {p.name for p in tmp_path.iterdir()} == {'456.json', metrics.path.name}
+    finally:
+        await metrics.stop()
+
+
+def test_metrics_pg(tmp_path):
+    metrics = Metrics(tmp_path, pool_stats=lambda: {'size': 3, 'idle': 1, 'max_size': 10, 'waiters': 0})
+    route = metrics.route('GET', '/')
+    route.pg_wait.observe(0.02)
+    route.pg_hold.observe(0.2)
+
+    other = Metrics(pool_stats=lambda: {'size': 5, 'idle': 0, 'max_size': 10, 'waiters': 2})
+    (tmp_path / '123.json').write_text(json.dumps(other.dump()))
+
+    lines = metrics.render().splitlines()
+    assert 'foxglove_pg_pool_size 8' in lines
+    assert 'foxglove_pg_pool_idle 1' in lines
+    assert 'foxglove_pg_pool_max_size 20' in lines
+    assert 'foxglove_pg_pool_waiters 2' in lines
+    assert 'foxglove_pg_acquire_seconds_bucket{method="GET",route="/",le="0.025"} 1' in lines
+    assert 'foxglove_pg_hold_seconds_sum{method="GET",route="/"} 0.200000' in lines
+
+    metrics = Metrics()
+    assert not any(line.startswith('foxglove_pg_pool_') for line in metrics.render().splitlines())
+
+
+def test_metrics_middleware_pg(settings, loop, mocker):
+    from foxglove.db import AsgiPgMiddleware
+    from foxglove.db.middleware import get_db
+
+    class Pool:
+        async def acquire(self, *, timeout=None):
+            return 'conn'
+
+        async def release(self, conn):
+            pass
+
+    mocker.patch.object(foxglove.glove, 'pg', Pool(), create=True)
+    app = FastAPI(middleware=[Middleware(MetricsMiddleware, path='/metrics'), Middleware(AsgiPgMiddleware)])
+
+    @app.get('/')
+    async def index(conn=Depends(get_db)):
+        return {'conn': conn}
+
+    with Client(app, loop=loop) as client:
+        assert client.get_json('/') == {'conn': 'conn'}
+        lines = client.get('/metrics').text.splitlines()
+
+    assert 'foxglove_pg_acquire_seconds_count{method="GET",route="/"} 1' in lines
+    assert 'foxglove_pg_hold_seconds_count{method="GET",route="/"} 1' in lines
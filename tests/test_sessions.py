@@ -0,0 +1,155 @@
+from datetime import datetime, timedelta
+from time import time
+
+import pytest
+from itsdangerous import TimestampSigner
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.sessions import SessionMiddleware as StarletteSessionMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from foxglove.sessions import SessionMiddleware
+from foxglove.testing import TestClient as Client
+
+
+async def view_session(request: Request):
+    return JSONResponse(dict(request.session))
+
+
+async def no_session(request: Request):
+    return JSONResponse({'loaded': request.scope['session'].loaded})
+
+
+async def peek_session(request: Request):
+    session = request.scope['session']
+    return JSONResponse({'peek': session.peek('foo'), 'loaded': session.loaded})
+
+
+async def update_session(request: Request):
+    request.session.update(await request.json())
+    return JSONResponse(dict(request.session))
+
+
+async def clear_session(request: Request):
+    request.session.clear()
+    return JSONResponse({})
+
+
+def create_app(session_middleware: type = SessionMiddleware, secret_key: str = 'testing', **kwargs) -> Starlette:
+    return Starlette(
+        routes=[
+            Route('/', view_session),
+            Route('/no-session/', no_session),
+            Route('/peek/', peek_session),
+            Route('/update/', update_session, methods=['POST']),
+            Route('/clear/', clear_session, methods=['POST']),
+        ],
+        middleware=[Middleware(session_middleware, secret_key=secret_key, session_cookie='sess', **kwargs)],
+    )
+
+
+@pytest.fixture(name='session_client')
+def _fix_session_client(settings, loop):
+    with Client(create_app(), loop=loop) as client:
+        yield client
+
+
+def test_session_set_read(session_client: Client):
+    assert session_client.get_json('/') == {}
+    assert 'set-cookie' not in session_client.last_response.headers
+
+    assert session_client.post_json('/update/', {'foo': 'bar'}) == {'foo': 'bar'}
+    set_cookie = session_client.last_response.headers['set-cookie']
+    assert set_cookie.startswith('sess=')
+    assert set_cookie.endswith('; path=/; Max-Age=1209600; httponly; samesite=lax')
+
+    # reading or rewriting the same session doesn't re-sign the cookie
+    assert session_client.get_json('/') == {'foo': 'bar'}
+    assert 'set-cookie' not in session_client.last_response.headers
+    assert session_client.post_json('/update/', {'foo': 'bar'}) == {'foo': 'bar'}
+    assert 'set-cookie' not in session_client.last_response.headers
+
+
+def test_session_lazy(session_client: Client):
+    session_client.post_json('/update/', {'foo': 'bar'})
+    assert session_client.get_json('/no-session/') == {'loaded': False}
+    assert 'set-cookie' not in session_client.last_response.headers
+
+
+def test_session_clear(session_client: Client):
+    session_client.post_json('/update/', {'foo': 'bar'})
+    assert session_client.post_json('/clear/') == {}
+    assert session_client.last_response.headers['set-cookie'] == (
+        'sess=null; path=/; expires=Thu, 01 Jan 1970 00:00:00 GMT; httponly; samesite=lax'
+    )
+    assert session_client.get_json('/') == {}
+
+
+def test_session_invalid_cookie(session_client: Client):
+    session_client.cookies.set('sess', 'foobar')
+    assert session_client.get_json('/') == {}
+    assert 'set-cookie' not in session_client.last_response.headers
+
+
+def test_session_peek(session_client: Client, mocker):
+    assert session_client.get_json('/peek/') == {'peek': False, 'loaded': False}
+    session_client.post_json('/update/', {'foo': 'bar'})
+    assert session_client.get_json('/peek/') == {'peek': True, 'loaded': False}
+    session_client.post_json('/update/', {'spam': 'bar'})
+    assert session_client.get_json('/peek/') == {'peek': True, 'loaded': False}
+
+    cookie = session_client.cookies['sess']
+    session_client.cookies.set('sess', 'foobar')
+    assert session_client.get_json('/peek/') == {'peek': False, 'loaded': False}
+
+    session_client.cookies.set('sess', cookie)
+    mocker.patch.object(TimestampSigner, 'get_timestamp', return_value=int(time()) + 15 * 24 * 3600)
+    assert session_client.get_json('/peek/') == {'peek': False, 'loaded': False}
+
+
+def test_session_peek_rotated_key(settings, loop):
+    with Client(create_app(secret_key='old-key'), loop=loop) as client:
+        client.post_json('/update/', {'foo': 'bar'})
+        cookie = client.cookies['sess']
+
+    with Client(create_app(secret_key='new-key'), loop=loop) as client:
+        client.cookies.set('sess', cookie)
+        # the payload contains "foo" but the signature is invalid
+        assert client.get_json('/peek/') == {'peek': False, 'loaded': False}
+
+
+def test_session_too_large(settings, loop, caplog):
+    with Client(create_app(max_cookie_size=100), loop=loop) as client:
+        assert client.post_json('/update/', {'foo': 'x' * 100}) == {'foo': 'x' * 100}
+        assert 'set-cookie' not in client.last_response.headers
+
+    assert [r.message for r in caplog.records if r.name == 'foxglove.sessions'] == [
+        'session cookie too large, 188 bytes, max 100 bytes, not updating cookie'
+    ]
+
+
+def test_session_refresh(settings, loop, mocker):
+    with Client(create_app(refresh_after=3600), loop=loop) as client:
+        client.post_json('/update/', {'foo': 'bar'})
+        assert client.get_json('/') == {'foo': 'bar'}
+        assert 'set-cookie' not in client.last_response.headers
+
+        mock_time = mocker.patch('foxglove.sessions.time')
+        mock_time.return_value = (datetime.now() + timedelta(hours=2)).timestamp()
+        assert client.get_json('/') == {'foo': 'bar'}
+        assert client.last_response.headers['set-cookie'].startswith('sess=')
+
+
+@pytest.mark.parametrize(
+    'first,second', [(StarletteSessionMiddleware, SessionMiddleware), (SessionMiddleware, StarletteSessionMiddleware)]
+)
+def test_session_starlette_compatible(settings, loop, first, second):
+    with Client(create_app(first), loop=loop) as client:
+        client.post_json('/update/', {'foo': 'bar', 'spam': [1, 2, 3]})
+        cookie = client.cookies['sess']
+
+    with Client(create_app(second), loop=loop) as client:
+        client.cookies.set('sess', cookie)
+        assert client.get_json('/') == {'foo': 'bar', 'spam': [1, 2, 3]}
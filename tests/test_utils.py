@@ -1,6 +1,6 @@
 import pytest
 
-from foxglove.utils import dict_not_none, list_not_none
+from foxglove.utils import dict_not_none, list_not_none, route_template
 
 
 def test_list_not_none():
@@ -16,3 +16,11 @@ def test_dict_not_none():
         dict_not_none({'a': 1}, {'b': None})
     with pytest.raises(TypeError, match='dict_not_none must be a dict, got list'):
         dict_not_none([1])
+
+
+def test_route_template():
+    from fastapi.routing import APIRoute
+
+    route = APIRoute('/users/{user_id:int}/', lambda user_id: None)
+    assert route_template({'route': route}) == '/users/{user_id}/'
+    assert route_template({}) is None